@@ -0,0 +1,567 @@
+import httplib
+import random
+import socket
+import sys
+import time
+import xmlrpclib
+
+from collectors import stages
+from common import *
+import command
+from compact import CHUNKED, chunks, iter_encode, json
+from dedup import DEDUP, batches, replace_bodies, sha256
+from delta import DeltaState
+from runner import CollectorRunner
+from spool import SectionStore, Spool
+
+# Upload errors worth retrying (and spooling for): the server could not be
+# reached or did not answer properly. Faults are not retried.
+UPLOAD_ERRORS = (socket.error, httplib.HTTPException, xmlrpclib.ProtocolError,
+                 xmlrpclib.ResponseError)
+
+
+def backoff(attempt, base, cap):
+    """
+    Return the seconds to wait before retry `attempt` (from 0): a random
+    time up to `base` * 2^`attempt`, at most `cap` ("full jitter").
+    """
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+class Agent:
+    """
+    Collect inventory sections and push them to the server.
+
+    `collectors` maps section names to `Collector`s (see `collectors.py`).
+    In daemon mode every collector runs on its own interval; sections that
+    are not due are pushed from their last results, which delta reporting
+    turns into hashes. A collector's `watch` paths are watched in daemon
+    mode, and a change to one of them re-runs that collector at once.
+
+    If `metrics` (a `Metrics`) is given, every collector and upload is
+    measured; with `send_metrics` the collector metrics are sent as an
+    extra `machine` argument.
+
+    The first collection waits a random 0..`splay` seconds. Failed uploads
+    are retried with backoff (see `[upload]` in `settings.conf`); if they
+    still fail, the full inventory is spooled and sent before the next
+    upload.
+
+    If the server offers chunked uploads (and `chunked` is set), each
+    section is streamed to the server as soon as its collector finishes,
+    in pieces of at most `chunk_size` bytes, instead of in one `machine`
+    call after all of them. If it offers body deduplication (and `dedup` is
+    set), configuration file bodies are sent by digest, and uploaded only
+    if the server does not have them yet.
+
+    With `section_dir` set, the latest results are kept on disk rather
+    than in memory, so a streamed upload only holds the sections being
+    collected and the one being sent.
+    """
+    def __init__(self, proxy, collectors, full=False, metrics=None,
+                 send_metrics=None, workers=None, splay=None):
+        if send_metrics is None:
+            send_metrics = config.SEND_METRICS
+        if workers is None:
+            workers = config.WORKER_THREADS
+        if splay is None:
+            splay = config.SPLAY
+        self.proxy = proxy
+        self.collectors = collectors
+        self.full = full
+        self.watcher = None
+        self.metrics = metrics
+        self.send_metrics = send_metrics
+        self.workers = workers
+        self.splay = splay
+        self.results = {}
+        if config.SECTION_DIR:
+            self.results = SectionStore.for_process(config.SECTION_DIR)
+        self.next_run = {}
+
+        self.snapshots = [c.snapshot for c in collectors.values()
+                          if c.snapshot is not None]
+        for snapshot in self.snapshots:
+            snapshot.load()
+
+        self.delta = None
+        if config.DELTA_ENABLED:
+            self.delta = DeltaState()
+            self.delta.load()
+
+        self.spool = None
+        if config.SPOOL_DIR:
+            self.spool = Spool()
+
+    def wait_splay(self):
+        """Sleep a random 0..`splay` seconds."""
+        if self.splay > 0:
+            time.sleep(random.uniform(0, self.splay))
+
+    def due(self, now):
+        """Return the names of the collectors due to run at `now`."""
+        return [name for name in self.collectors
+                if self.next_run.get(name, 0) <= now]
+
+    def iter_collect(self, names):
+        """
+        Run the named collectors, keep their results and generate (name,
+        result) pairs as they finish. Collectors run concurrently in stages
+        (see `collectors.stages`): each after those it requires, the most
+        expensive first.
+
+        A collector that fails (and those requiring it) keeps its previous
+        result, if any, and is run again after `collector_retry` seconds;
+        the first error is re-raised once the others have finished.
+        """
+        now = time.time()
+        failed = {}
+        error = None
+
+        # Commands run by several collectors are run once per round.
+        command.clear_cache()
+
+        for stage in stages(self.collectors, names):
+            runnable = []
+            for name in stage:
+                if [r for r in self.collectors[name].requires if r in failed]:
+                    failed[name] = True
+                else:
+                    runnable.append(name)
+
+            runner = CollectorRunner(self.workers)
+            for name in runnable:
+                if self.metrics:
+                    runner.add(self.metrics.wrap(name, self.collectors[name]))
+                else:
+                    runner.add(self.collectors[name])
+
+            done = {}
+            try:
+                for index, result in runner.iter_run():
+                    name = runnable[index]
+                    self.results[name] = result
+
+                    watch = self.collectors[name].watch
+                    if self.watcher and watch:
+                        files, dirs = watch(result)
+                        self.watcher.watch(name, files, dirs)
+
+                    done[name] = True
+                    self.next_run[name] = now + self.collectors[name].interval
+                    yield name, result
+            except Exception:
+                if error is None:
+                    error = sys.exc_info()
+
+            for name in runnable:
+                if name not in done:
+                    failed[name] = True
+
+        for name in failed:
+            self.next_run[name] = now + min(config.COLLECTOR_RETRY,
+                                            self.collectors[name].interval)
+        if error:
+            raise error[0], error[1], error[2]
+
+    def collect(self, names):
+        """Run the named collectors and keep their results."""
+        for name, result in self.iter_collect(names):
+            pass
+
+    def retry(self, func, *args):
+        """
+        Call `func(*args)`, retrying on connection and protocol errors with
+        backoff, and return its result.
+        """
+        attempt = 0
+        while True:
+            try:
+                return func(*args)
+            except UPLOAD_ERRORS, error:
+                if attempt >= config.RETRIES:
+                    raise
+                delay = backoff(attempt, config.BACKOFF_BASE,
+                                config.BACKOFF_MAX)
+                print "Notice: Cannot upload inventory: %s (retrying in " \
+                      "%.1f seconds)" % (error, delay)
+                time.sleep(delay)
+                attempt += 1
+
+    def send(self, args, measure=False):
+        """
+        Call `authenticate` and `machine(*args)` in one request (with
+        retries) and return their results.
+        """
+        def call():
+            multicall = xmlrpclib.MultiCall(self.proxy)
+
+            # Send authentication key.
+            multicall.authenticate(config.AUTH_TOKEN)
+            multicall.machine(*args)
+
+            if measure:
+                result = self.metrics.measure('upload', multicall)
+            else:
+                result = multicall()
+
+            # Indexing raises `xmlrpclib.Fault` for failed calls.
+            return (result[0], result[1])
+
+        return self.retry(call)
+
+    def drain(self):
+        """
+        Send the spooled inventories, oldest first (or only the newest if
+        `spool_collapse` is set). Raises on the first failed upload, and
+        stops if authentication fails.
+        """
+        names = self.spool.names()
+        if names and config.SPOOL_COLLAPSE:
+            for name in names[:-1]:
+                self.spool.remove(name)
+            names = names[-1:]
+
+        for name in names:
+            try:
+                sections = self.spool.get(name)
+            except (IOError, EOFError, ValueError, xmlrpclib.Error), error:
+                print "Notice: Dropped unreadable spooled inventory '%s': " \
+                      "%s" % (name, error)
+                self.spool.remove(name)
+                continue
+
+            if not self.send_spooled(sections):
+                return
+            self.spool.remove(name)
+
+            # The server now has a newer inventory than the delta state.
+            self.full = True
+
+    def send_spooled(self, sections):
+        """
+        Send a spooled inventory, streaming a spooled directory section by
+        section if the server offers chunked uploads. Returns whether the
+        server authenticated the upload.
+        """
+        if isinstance(sections, SectionStore):
+            if self.chunked():
+                session = self.retry(self.proxy.session_begin,
+                                     config.AUTH_TOKEN)
+                if not session:
+                    return False
+                try:
+                    for name, section in sections.iteritems():
+                        self.send_section(session, name, section)
+                    self.retry(self.proxy.session_commit, session, {})
+                    return True
+                except UnicodeError:
+                    self.abort_session(session)
+            sections = dict(sections.iteritems())
+
+        return self.send([self.send_bodies(sections)])[0]
+
+    def spool_latest(self):
+        """Spool the latest result of every section (in full)."""
+        if isinstance(self.results, SectionStore):
+            # Linked from the section files rather than read into memory.
+            self.spool.put(self.results, [name for name in self.collectors
+                                          if name in self.results])
+        else:
+            self.spool.put(self.latest())
+        self.full = True
+
+    def section(self, name, result):
+        """
+        Return payload section `name` for a collector `result`: built by
+        the collector's snapshot, if any, and replaced by its hash if it did
+        not change since the last successful upload.
+        """
+        snapshot = self.collectors[name].snapshot
+        if snapshot is not None:
+            result = snapshot.build(result, self.full)
+        if self.delta:
+            result = self.delta.build_section(name, result, self.full)
+        return result
+
+    def send_bodies(self, sections):
+        """
+        Upload the bodies of the `dedup` collectors' sections in `sections`
+        ({name: section}) that the server does not have, and return a copy
+        of `sections` with those bodies replaced by their digests.
+        """
+        if not self.dedup():
+            return sections
+
+        sections = sections.copy()
+        bodies = {}
+        for name, section in sections.iteritems():
+            collector = self.collectors.get(name)
+            if collector is not None and collector.dedup:
+                sections[name], found = replace_bodies(section,
+                                                       config.DEDUP_MIN_SIZE)
+                bodies.update(found)
+
+        if bodies:
+            missing = self.retry(self.proxy.bodies_missing, config.AUTH_TOKEN,
+                                 bodies.keys())
+            missing = dict([(d, bodies[d]) for d in missing if d in bodies])
+            for batch in batches(missing, config.CHUNK_SIZE):
+                self.retry(self.proxy.bodies_put, config.AUTH_TOKEN, batch)
+
+        return sections
+
+    def collector_metrics(self):
+        """Return the collector metrics to send, or None."""
+        if self.metrics and self.send_metrics:
+            return dict([(name, record) for name, record in
+                         self.metrics.records.iteritems()
+                         if name in self.collectors])
+        return None
+
+    def payload(self, sections):
+        """Return the `machine` arguments for an inventory ({name: section})."""
+        if self.delta:
+            self.delta.begin()
+        args = [dict([(name, self.section(name, result))
+                      for name, result in sections.iteritems()])]
+
+        metrics = self.collector_metrics()
+        if metrics is not None:
+            args.append(metrics)
+        return args
+
+    def bytes_sent(self):
+        """Return the bytes sent so far by the transport, or None."""
+        transport = getattr(self.proxy, 'transport', None) or \
+                    getattr(self.proxy, '_ServerProxy__transport', None)
+        return getattr(transport, 'bytes_sent', None)
+
+    def record_bytes_sent(self, before):
+        """
+        Add the bytes sent since `bytes_sent` returned `before` to the
+        upload metrics.
+        """
+        after = self.bytes_sent()
+        if before is not None and after is not None and \
+           'upload' in self.metrics.records:
+            self.metrics.records['upload']['bytes_sent'] = after - before
+
+    def uploaded(self):
+        """Commit the delta state and snapshots after a successful upload."""
+        if self.delta:
+            self.delta.commit()
+        for snapshot in self.snapshots:
+            snapshot.commit()
+        self.full = False
+
+    def latest(self):
+        """Return the latest result of every section ({name: section})."""
+        sections = {}
+        for name in self.collectors:
+            result = self.results.get(name)
+            if result is not None:
+                sections[name] = result
+        return sections
+
+    def push(self):
+        """
+        Send any spooled inventories, then the latest result of every
+        section (sections whose collectors never succeeded are left out),
+        and return the results of `authenticate` and `machine`. If the
+        upload fails, the inventory is spooled (in full) before the error
+        is raised. Nothing is committed if authentication fails.
+        """
+        sections = self.latest()
+        bytes_sent = self.bytes_sent()
+
+        try:
+            if self.spool:
+                self.drain()
+            args = self.payload(sections)
+            args[0] = self.send_bodies(args[0])
+            result = self.send(args, measure=self.metrics is not None)
+        except UPLOAD_ERRORS:
+            if self.spool:
+                self.spool.put(sections)
+                self.full = True
+            raise
+
+        if not result[0]:
+            # The server did not keep the inventory; resend it in full.
+            self.full = True
+            return result
+
+        if self.metrics:
+            self.record_bytes_sent(bytes_sent)
+        self.uploaded()
+
+        return result
+
+    def send_section(self, session, name, section):
+        """Upload payload section `name` to a session, chunk by chunk."""
+        section = self.send_bodies({name: section})[name]
+        pieces = iter_encode(section)
+        for index, (data, final) in enumerate(chunks(pieces,
+                                                     config.CHUNK_SIZE)):
+            self.retry(self.proxy.session_chunk, session, name, index, data,
+                       final)
+
+    def commit_session(self, session, names):
+        """Upload the sections not streamed yet, then commit the session."""
+        for name in names:
+            result = self.results.get(name)
+            if result is not None:
+                self.send_section(session, name, self.section(name, result))
+        return self.retry(self.proxy.session_commit, session,
+                          self.collector_metrics() or {})
+
+    def abort_session(self, session):
+        try:
+            self.proxy.session_abort(session)
+        except UPLOAD_ERRORS + (xmlrpclib.Fault,):
+            pass
+
+    def stream(self, names):
+        """
+        Run the named collectors and upload each section to a chunked
+        session as soon as its collector finishes, then the sections not
+        run from their last results, and commit. Returns the results of
+        authentication and the commit, like `push`; if authentication
+        fails, nothing is uploaded and the commit result is None.
+
+        Upload errors do not stop the collection: once it ends, the
+        inventory is spooled (in full) and the error raised. Sections that
+        the compact encoding cannot carry (strings that are not UTF-8) are
+        sent with `push` instead.
+        """
+        error = None
+        session = None
+        bytes_sent = self.bytes_sent()
+        try:
+            if self.spool:
+                self.drain()
+            session = self.retry(self.proxy.session_begin, config.AUTH_TOKEN)
+        except UPLOAD_ERRORS + (xmlrpclib.Fault,):
+            error = sys.exc_info()
+
+        if self.delta:
+            self.delta.begin()
+
+        streamed = {}
+        fallback = False
+        try:
+            for name, result in self.iter_collect(names):
+                if error or fallback or not session:
+                    continue
+                try:
+                    self.send_section(session, name,
+                                      self.section(name, result))
+                    streamed[name] = True
+                except UnicodeError:
+                    fallback = True
+                except UPLOAD_ERRORS + (xmlrpclib.Fault,):
+                    error = sys.exc_info()
+        except Exception, collect_error:
+            # The other sections are still uploaded.
+            print "Notice: Cannot collect inventory: %s" % collect_error
+
+        rest = [name for name in self.collectors
+                if name not in streamed and name in self.results]
+        if session and not error and not fallback:
+            try:
+                if self.metrics:
+                    result = self.metrics.measure('upload',
+                                                  self.commit_session,
+                                                  session, rest)
+                else:
+                    result = self.commit_session(session, rest)
+            except UnicodeError:
+                fallback = True
+            except UPLOAD_ERRORS + (xmlrpclib.Fault,):
+                error = sys.exc_info()
+
+        if fallback:
+            self.abort_session(session)
+            return self.push()
+
+        if error:
+            if self.spool and issubclass(error[0], UPLOAD_ERRORS):
+                self.spool_latest()
+            raise error[0], error[1], error[2]
+
+        # The server only opens a session for an authenticated client.
+        if not session:
+            return (False, None)
+
+        if self.metrics:
+            self.record_bytes_sent(bytes_sent)
+        self.uploaded()
+
+        return (True, result)
+
+    def offers(self, name):
+        """Return whether the server offers encoding (or protocol) `name`."""
+        if not hasattr(self.proxy, 'offers'):
+            return False
+        try:
+            return self.proxy.offers(name)
+        except UPLOAD_ERRORS + (xmlrpclib.Fault,), error:
+            print "Notice: Cannot ask the server for its encodings: %s" % error
+            return False
+
+    def chunked(self):
+        """Return whether to stream sections to the server."""
+        return config.CHUNKED and json is not None and self.offers(CHUNKED)
+
+    def dedup(self):
+        """Return whether to send configuration file bodies by digest."""
+        return config.DEDUP and sha256 is not None and self.offers(DEDUP)
+
+    def run_round(self, names):
+        """
+        Run the named collectors and upload the inventory, streaming it if
+        the server offers chunked uploads; return the results of `push`.
+        """
+        if self.chunked():
+            return self.stream(names)
+        try:
+            self.collect(names)
+        except Exception, error:
+            # The other sections are still uploaded.
+            print "Notice: Cannot collect inventory: %s" % error
+        return self.push()
+
+    def run_once(self):
+        """Run every collector and push the inventory."""
+        self.wait_splay()
+        return self.run_round(self.collectors.keys())
+
+    def run_forever(self):
+        """
+        Run collectors as they fall due (or as their watched files change)
+        and push after each round.
+        """
+        if config.WATCH_ENABLED and \
+           [c for c in self.collectors.values() if c.watch]:
+            from watcher import get_watcher
+            self.watcher = get_watcher()
+
+        self.wait_splay()
+        while True:
+            names = self.due(time.time())
+
+            if names:
+                try:
+                    self.run_round(names)
+                except UPLOAD_ERRORS + (xmlrpclib.Error,), error:
+                    print "Notice: Cannot upload inventory: %s" % error
+                except Exception, error:
+                    print "Notice: Cannot collect inventory: %s" % error
+
+            wait = min(self.next_run.values()) - time.time()
+            if self.watcher:
+                for name in self.watcher.wait(max(0, wait)):
+                    self.next_run[name] = 0
+            elif wait > 0:
+                time.sleep(wait)
@@ -6,61 +6,125 @@ import sys
 from common import *
 
 
-class ApacheNode:
+class ApacheNode(object):
+    """
+    A directive or section of an Apache configuration. Nodes use `__slots__`,
+    interned names and tuple values to keep large trees compact. Every node
+    but the root points to its parent (the slot costs the same either way).
+    """
+    __slots__ = ('name', 'values', 'children', 'section', 'parent',
+                 '_child_index', '_descendant_index')
+
     re_comment = re.compile(r"""^#.*$""")
     re_section_start = re.compile(r"""^<(?P<name>[^/\s>]+)\s*(?P<value>[^>]+)?>$""")
     re_section_end = re.compile(r"""^</(?P<name>[^\s>]+)\s*>$""")
     #re_statement = re.compile(r"""^(?P<name>[^\s]+)\s*(?P<value>.+)?$""")
 
-    def __init__(self, name, values=[], section=False):
-        self.name = name
-        self.children = []
-        self.values = values
+    def __init__(self, name, values=(), section=False):
+        self.name = intern(name)
+        self.values = tuple(values)
+        # Directives share an empty tuple until a child is added.
+        if section:
+            self.children = []
+        else:
+            self.children = ()
         self.section = section
+        self.parent = None
+        self._child_index = None
+        self._descendant_index = None
 
     def add_child(self, child):
-        self.children.append(child)
+        """
+        Append `child` and invalidate the lookup indexes of this node and
+        its ancestors (so `findall` sees the child from any of them).
+        """
+        if not self.children:
+            self.children = [child]
+        else:
+            self.children.append(child)
         child.parent = self
+
+        # Invalidate lookup indexes of this node and its ancestors.
+        node = self
+        while node is not None:
+            node._child_index = node._descendant_index = None
+            node = node.parent
+
         return child
 
+    def get_child_index(self):
+        """
+        Return (and lazily build) a dictionary of case-folded names to
+        children.
+        """
+        if self._child_index is None:
+            self._child_index = {}
+            for child in self.children:
+                self._child_index.setdefault(child.name.lower(), []).append(child)
+        return self._child_index
+
+    def get_descendant_index(self):
+        """
+        Return (and lazily build) a dictionary of case-folded names to
+        descendants, in document order.
+        """
+        if self._descendant_index is None:
+            self._descendant_index = {}
+            stack = self.children[::-1]
+            while stack:
+                node = stack.pop()
+                self._descendant_index.setdefault(node.name.lower(), []).append(node)
+                stack.extend(node.children[::-1])
+        return self._descendant_index
+
+    def _steps(self, path):
+        """
+        Split a path into a list of (case-folded name, descendant) steps. An
+        element preceded by `//` matches descendants at any depth (e.g.,
+        `//ServerName` or `VirtualHost//ServerName`).
+        """
+        steps = []
+        descendant = False
+
+        for index, element in enumerate(path.split('/')):
+            if not element:
+                if index:
+                    descendant = True
+                continue
+            steps.append((element.lower(), descendant))
+            descendant = False
+
+        return steps
+
     def find(self, path):
         """Return the first element which matches the path."""
-        pathelements = path.strip('/').split('/')
-        if not pathelements[0]:
-            return self
-        return self._find(pathelements)
-
-    def _find(self, pathelements):
-        if pathelements: # There is still more to do ...
-            next = pathelements.pop(0)
-            for child in self.children:
-                # Case-insensitive comparison.
-                if child.name.lower() == next.lower():
-                    result = child._find(pathelements)
-                    if result:
-                        return result
-            return None
-        else: # no pathelements left, result is self
-            return self
+        result = self.findall(path)
+        if result:
+            return result[0]
+        return None
 
     def findall(self, path):
         """Return all elements which match the path."""
-        pathelements = path.strip('/').split('/')
-        if not pathelements[0]:
-            return [self]
-        return self._findall(pathelements)
+        nodes = [self]
 
-    def _findall(self, pathelements):
-        if pathelements: # there is still more to do ...
+        for name, descendant in self._steps(path):
             result = []
-            next = pathelements.pop(0)
-            for child in self.children:
-                # Case-insensitive comparison.
-                if child.name.lower() == next.lower():
-                    result.extend(child._findall(pathelements))
-            return result
-        else: # no pathelements left, result is self
-            return [self]
+            seen = {}
+            for node in nodes:
+                if descendant:
+                    matches = node.get_descendant_index().get(name, [])
+                else:
+                    matches = node.get_child_index().get(name, [])
+
+                for match in matches:
+                    # Nested matches can be reached from several nodes.
+                    if descendant and id(match) in seen:
+                        continue
+                    seen[id(match)] = True
+                    result.append(match)
+            nodes = result
+
+        return nodes
 
     def print_r(self, indent=-1):
         """Recursively print node."""
@@ -76,42 +140,46 @@ class ApacheNode:
                 print '    ' * indent + self.name + ' ' + ' '.join(self.values)
 
     @classmethod
-    def parse_file(cls, file):
+    def parse_file(cls, file, body=None):
         """Parse a file."""
         try:
             f = open(file)
-            root = cls._parse(f)
-            f.close()
+            try:
+                root = cls._parse(f, body)
+            finally:
+                f.close()
             return root
         except IOError:
             return False
 
     @classmethod
-    def parse_string(cls, string):
+    def parse_string(cls, string, body=None):
         """Parse a string."""
-        return cls._parse(string.splitlines())
+        return cls._parse(string.splitlines(), body)
 
     @classmethod
-    def _parse(cls, itobj):
+    def _parse(cls, itobj, body=None):
+        """
+        Parse lines into a tree of nodes. If `body` is a list, each cleaned
+        line (see `clean_lines`) is appended to it as well.
+        """
         root = node = ApacheNode('', section=True)
 
-        for line in itobj:
-            line = line.strip()
+        for line in clean_lines(itobj, '#'):
+            if body is not None:
+                body.append('%s\n' % line)
 
-            if not line or cls.re_comment.match(line):
+            if cls.re_comment.match(line):
                 continue
 
-            # Concatenate multiline directives delimited by backslash-newlines.
-            if line and line[-1] == '\\':
-                while line[-1] == '\\':
-                    line = ' '.join([line[:-1].strip(), itobj.next().strip()])
-
             m = cls.re_section_start.match(line)
             if m:
                 values = m.group('value').split()
                 new_node = ApacheNode(m.group('name'), values=values,
                                       section=True)
-                node = node.add_child(new_node)
+                new_node.parent = node
+                node.children.append(new_node)
+                node = new_node
                 continue
 
             m = cls.re_section_end.match(line)
@@ -129,7 +197,9 @@ class ApacheNode:
             if name[0].islower():
                 name = name[0].upper() + name[1:]
 
-            node.add_child(ApacheNode(name, values=values, section=False))
+            new_node = ApacheNode(name, values=values, section=False)
+            new_node.parent = node
+            node.children.append(new_node)
 
         return root
 
@@ -137,28 +207,32 @@ class ApacheNode:
 class ApacheConfig:
     def __init__(self):
         self.filename = None
-        self.ac = None
         self.root = None
+        self.body = ''
         self.directives = {}
         self.domains = {}
+        self.includes = []
+        self.include_patterns = []
+        self.server_root = None
 
     def parse(self, filename):
+        """
+        Read and parse the file once, building the cleaned body, node tree,
+        directives, domains and includes together.
+        """
         self.filename = filename
-        self.ac = ApacheNode(filename)
-        self.root = self.ac.parse_file(filename)
-        self.scan_children(self.root.children)
 
-    def get_body(self):
-        re_comment = re.compile(r"""^#.*$""")
+        body = []
+        self.root = ApacheNode.parse_file(filename, body)
+        if not self.root:
+            self.root = ApacheNode('', section=True)
+        self.body = ''.join(body)
 
-        try:
-            config_file = open(self.filename, 'r')
-            config_lines = config_file.readlines()
-            config_file.close()
-        except IOError:
-            return ''
+        self.scan_children(self.root.children, top=True)
+        self.includes = self.resolve_includes()
 
-        return clean_body(config_lines, '#')
+    def get_body(self):
+        return self.body
 
     def print_children(self, children, indent=-1):
         """Recursively print children."""
@@ -169,15 +243,18 @@ class ApacheConfig:
                   child.section and '-----' or ''
             print_children(child.children, indent)
 
-    def scan_children(self, children, indent=-1):
-        """Recursively scan children and build directives dictionary."""
-        body_list = []
+    def scan_children(self, children, top=False):
+        """
+        Recursively scan children and build directives and domains
+        dictionaries. `Include` patterns and `ServerRoot` are collected from
+        the top-level children in the same pass.
+        """
         for child in children:
             name = child.name
             value = ' '.join(child.values)
 
-            body_list.append({'name': name, 'value': value,
-                'children': self.scan_children(child.children, indent)})
+            if child.children:
+                self.scan_children(child.children)
 
             if name in self.directives:
                 self.directives[name] += [value]
@@ -188,50 +265,57 @@ class ApacheConfig:
             else:
                 self.directives[name] = [value]
 
-        return body_list
+            # Virtual hosts may be nested (e.g., in `<IfModule>` blocks).
+            if name.lower() == 'virtualhost':
+                self.add_domain(child)
 
-    def get_directives(self):
-        return self.directives
+            if top:
+                self.scan_top_level(child)
 
-    def get_domains(self):
-        vh = self.root.findall('VirtualHost')
+    def scan_top_level(self, child):
+        name = child.name.lower()
+
+        if name == 'include':
+            self.include_patterns.append(''.join(child.values))
+        elif name == 'serverroot' and self.server_root is None:
+            self.server_root = ''.join(child.values)
+
+    def add_domain(self, v):
+        ports_str = ' '.join(v.values)
 
-        for v in vh:
-            ports_str = ' '.join(v.values)
+        # Strip all non-numeric characters.
+        p = re.compile(r'[^0-9]+')
+        ports_str = p.sub(' ', ports_str).strip()
 
-            # Strip all non-numeric characters.
-            p = re.compile(r'[^0-9]+')
-            ports_str = p.sub(' ', ports_str).strip()
+        ports = re.split(' ', ports_str)
 
-            ports = re.split(' ', ports_str)
+        sn = v.findall('//ServerName')
+        if sn:
+            dn = sn[0].values[0]
+            self.domains.setdefault(dn, []).append(ports)
 
-            sn = v.findall('ServerName')
-            if sn:
-                dn = sn[0].values[0]
-                self.domains.setdefault(dn, []).append(ports)
+    def get_directives(self):
+        return self.directives
 
+    def get_domains(self):
         return self.domains
 
-    def get_includes(self):
+    def resolve_includes(self):
         included_list = []
 
-        sr_node = self.root.find('ServerRoot')
-
-        if DEBUG:
-            server_root = APACHE_ROOT
+        if config.DEBUG:
+            server_root = config.APACHE_ROOT
         else:
-            if sr_node:
-                server_root = ''.join(sr_node.values)
+            if self.server_root:
+                server_root = self.server_root
                 # Strip quotation marks.
                 if server_root[0] in ('"', "'") and \
                    server_root[0] == server_root[-1]:
                     server_root = server_root[1:-1]
             else:
-                server_root = APACHE_ROOT
-
-        for i in self.root.findall('Include'):
-            i = ''.join(i.values)
+                server_root = config.APACHE_ROOT
 
+        for i in self.include_patterns:
             i_fn = os.path.join(server_root, i)
 
             # Shell-style filename expansion (e.g., `conf.d/*.conf`).
@@ -239,3 +323,5 @@ class ApacheConfig:
 
         return included_list
 
+    def get_includes(self):
+        return self.includes
@@ -0,0 +1,626 @@
+#!/usr/bin/env python
+"""
+Benchmarks for the inventory collectors, run against synthetic fixtures
+with subprocess output injected.
+
+    python benchmark.py [--sizes=1000,10000,100000] [--cases=name,...]
+                        [--save-baseline=FILE] [--compare=FILE]
+
+Each case is run at every size in a forked child process and reports the
+best wall time of three runs, the peak RSS growth of the first run, and the
+scaling exponent between the smallest and largest size (1.0 is linear).
+Payload encodings (XML-RPC and compact JSON, with and without compression)
+are compared on a synthetic inventory, and agent startup (imports, and an
+empty run with no collectors due) is timed in fresh interpreters.
+"""
+from optparse import OptionParser
+import math
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import xmlrpclib
+import zlib
+
+from apacheparser import ApacheNode
+from common import *
+from compact import decode_request, encode_request, json
+from inventory import ApacheConfigList, INIConfig, Interfaces, IPTables, \
+                      RPMs, RPMSnapshot, Services, SSHConfig
+from transport import gzip_decode, gzip_encode
+
+
+## Fixtures.
+
+def iptables_fixture(n):
+    """Return an `iptables-save` dump with `n` rules."""
+    lines = ['# Generated by iptables-save v1.3.5 on Mon Jan  1 00:00:00 2024',
+             '*filter',
+             ':INPUT ACCEPT [0:0]',
+             ':FORWARD ACCEPT [0:0]',
+             ':OUTPUT ACCEPT [1024:65536]']
+    for i in range(n):
+        lines.append('-A INPUT -s 10.%d.%d.%d/32 -p tcp -m tcp --dport %d '
+                     '-j ACCEPT' % ((i >> 16) & 255, (i >> 8) & 255, i & 255,
+                                    1024 + i % 60000))
+    lines += ['COMMIT', '# Completed on Mon Jan  1 00:00:00 2024']
+    return '\n'.join(lines) + '\n'
+
+
+def httpd_fixture(n):
+    """Return an `httpd.conf` body with `n` lines of virtual hosts."""
+    lines = ['ServerRoot "/etc/httpd"', 'Listen 80']
+    i = 0
+    while len(lines) < n:
+        lines += ['',
+                  '# Virtual host %d.' % i,
+                  '<VirtualHost *:80>',
+                  '    ServerName www%d.example.com' % i,
+                  '    DocumentRoot /var/www/%d' % i,
+                  '    RewriteRule ^/old/(.*)$ \\',
+                  '        /new/$1 [R=301,L]',
+                  '</VirtualHost>']
+        i += 1
+    return '\n'.join(lines[:n]) + '\n'
+
+
+def httpd_tree_fixture(tmp_dir, n):
+    """
+    Write an `httpd.conf` including `n` virtual host files from `conf.d`;
+    every virtual host file includes the same `common` files (a diamond),
+    and the first one includes `httpd.conf` again (a cycle). Return the
+    path of `httpd.conf`.
+    """
+    conf_d = os.path.join(tmp_dir, 'conf.d')
+    common_d = os.path.join(tmp_dir, 'common')
+    os.makedirs(conf_d)
+    os.makedirs(common_d)
+
+    conf_fn = os.path.join(tmp_dir, 'httpd.conf')
+    write_file(conf_fn, 'Listen 80\nInclude %s/*.conf\n' % conf_d)
+
+    for i in range(4):
+        write_file(os.path.join(common_d, 'common%d.conf' % i),
+                   'Header set X-Common-%d on\n' % i)
+
+    for i in range(n):
+        body = 'Include %s/*.conf\n' % common_d
+        if i == 0:
+            body += 'Include %s\n' % conf_fn
+        body += httpd_fixture(40)
+        write_file(os.path.join(conf_d, 'site%05d.conf' % i), body)
+
+    return conf_fn
+
+
+def lsof_fixture(n):
+    """Return `lsof -ni -P` output with `n` open files (a tenth listening)."""
+    lines = ['COMMAND     PID   USER   FD   TYPE DEVICE SIZE/OFF NODE NAME']
+    for i in range(n):
+        if i % 10:
+            lines.append('httpd%-5d %5d apache %3du IPv4 %6d      0t0  TCP '
+                         '10.0.0.1:80->10.1.%d.%d:%d (ESTABLISHED)' % (
+                         i % 50, 1000 + i, i % 100, i, (i >> 8) & 255,
+                         i & 255, 1024 + i % 60000))
+        else:
+            lines.append('httpd%-5d %5d apache %3du IPv4 %6d      0t0  TCP '
+                         '*:%d (LISTEN)' % (i % 50, 1000 + i, i % 100, i,
+                                            1024 + i % 60000))
+    return '\n'.join(lines) + '\n'
+
+
+def proc_fixture(tmp_dir, n):
+    """
+    Write a `/proc` tree with `n` processes, each with a listening TCP
+    socket and a few other descriptors. Return its path.
+    """
+    net_dir = os.path.join(tmp_dir, 'net')
+    os.makedirs(net_dir)
+
+    tcp = ['  sl  local_address rem_address   st tx_queue rx_queue tr '
+           'tm->when retrnsmt   uid  timeout inode']
+    for i in range(n):
+        inode = 100000 + i
+        tcp.append('%4d: 00000000:%04X 00000000:0000 0A 00000000:00000000 '
+                   '00:00000000 00000000     0        0 %d 1 0000000000000000 '
+                   '100 0 0 10 0' % (i, 1024 + i % 60000, inode))
+
+        fd_dir = os.path.join(tmp_dir, str(1000 + i), 'fd')
+        os.makedirs(fd_dir)
+        write_file(os.path.join(tmp_dir, str(1000 + i), 'stat'),
+                   '%d (proc%d) S 1 %d %d 0 -1\n' % (1000 + i, i % 50,
+                                                   1000 + i, 1000 + i))
+        os.symlink('/dev/null', os.path.join(fd_dir, '0'))
+        os.symlink('pipe:[%d]' % inode, os.path.join(fd_dir, '1'))
+        os.symlink('socket:[%d]' % inode, os.path.join(fd_dir, '3'))
+
+    write_file(os.path.join(net_dir, 'tcp'), '\n'.join(tcp) + '\n')
+    return tmp_dir
+
+
+def ifconfig_fixture(n):
+    """Return `ifconfig` output (older net-tools format) for `n` interfaces."""
+    lines = []
+    for i in range(n):
+        lines += ['veth%-6d Link encap:Ethernet  HWaddr 02:42:AC:%02X:%02X:%02X'
+                  % (i, (i >> 16) & 255, (i >> 8) & 255, i & 255),
+                  '          inet addr:10.%d.%d.1  Bcast:10.%d.%d.255  '
+                  'Mask:255.255.255.0' % ((i >> 8) & 255, i & 255,
+                                          (i >> 8) & 255, i & 255),
+                  '          UP BROADCAST RUNNING MULTICAST  MTU:1500  Metric:1',
+                  '          RX packets:0 errors:0 dropped:0 overruns:0 frame:0',
+                  '']
+    return '\n'.join(lines) + '\n'
+
+
+def rpmpkgs_fixture(n):
+    """Return an `rpmpkgs` file body with `n` packages."""
+    return ''.join(['package%d-1.%d-%d.el5.x86_64.rpm\n' % (i, i % 10, i % 7)
+                    for i in range(n)])
+
+
+def sshd_config_fixture(n):
+    """Return an `sshd_config` body with `n` lines."""
+    lines = []
+    for i in range(n):
+        if i % 4 == 0:
+            lines.append('# Comment %d.' % i)
+        elif i % 4 == 1:
+            lines.append('Match User user%d' % i)
+        else:
+            lines.append('    AllowTcpForwarding %s' % (i % 2 and 'yes' or 'no'))
+    return '\n'.join(lines) + '\n'
+
+
+def my_cnf_fixture(n):
+    """Return a `my.cnf` body with `n` lines."""
+    lines = []
+    for i in range(n):
+        if i % 50 == 0:
+            lines.append('[mysqld%d]' % i)
+        elif i % 10 == 0:
+            lines.append('skip-option-%d' % i)
+        else:
+            lines.append('option_%d = %d' % (i, i))
+    return '\n'.join(lines) + '\n'
+
+
+def write_file(fn, body):
+    f = open(fn, 'w')
+    try:
+        f.write(body)
+    finally:
+        f.close()
+
+
+def write_fixture(tmp_dir, basename, body):
+    fn = os.path.join(tmp_dir, basename)
+    write_file(fn, body)
+    return fn
+
+
+## Inventories.
+
+def synthetic_inventory(scale):
+    """
+    Return an inventory ({name: section}) parsed from synthetic fixtures
+    of about `scale` lines (packages, rules, ...) per section.
+    """
+    tmp_dir = tempfile.mkdtemp(prefix='secinv-loadsim-')
+    try:
+        apache_list = ApacheConfigList()
+        apache_list.recurse(httpd_tree_fixture(tmp_dir, max(1, scale / 100)))
+
+        packages = RPMs._read_rpmpkgs(
+            write_fixture(tmp_dir, 'rpmpkgs', rpmpkgs_fixture(scale)))
+
+        inventory = {
+            'interfaces': Interfaces._get_ifconfig_interfaces(
+                ifconfig_fixture(max(1, scale / 100))),
+            'system': {'sys_ip': '10.0.0.1', 'hostname': 'localhost',
+                       'kernel_rel': '2.6.18-194.el5',
+                       'rh_rel': 'CentOS release 5.5 (Final)', 'nfs': 0,
+                       'ip_fwd': 0},
+            'services': Services._get_lsof_services(lsof_fixture(scale)),
+            'rpms': {'full': True, 'packages': packages},
+            'sshd': SSHConfig.parse(write_fixture(
+                tmp_dir, 'sshd_config', sshd_config_fixture(scale))),
+            'iptables': {'status': '',
+                         'rules': IPTables._parse(iptables_fixture(scale))},
+            'apache': apache_list.apache_configs,
+            'mysql': INIConfig(write_fixture(
+                tmp_dir, 'my.cnf', my_cnf_fixture(scale))).parse(),
+        }
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    return inventory
+
+
+## Cases: (name, unit, size divisor, setup(tmp_dir, n) -> (func, args)).
+
+def setup_ini(tmp_dir, n):
+    ini = INIConfig(write_fixture(tmp_dir, 'my.cnf', my_cnf_fixture(n)))
+
+    def parse():
+        INIConfig.cache.clear()
+        return ini.parse()
+    return parse, ()
+
+
+def setup_rpm_diff(tmp_dir, n):
+    packages = RPMs._read_rpmpkgs(
+        write_fixture(tmp_dir, 'rpmpkgs', rpmpkgs_fixture(n)))
+    snapshot = RPMSnapshot(os.path.join(tmp_dir, 'snapshot'))
+    snapshot.packages = dict([(RPMSnapshot.key(p), p) for p in packages[1:]])
+    return snapshot.diff, (packages,)
+
+
+def setup_apache_list(tmp_dir, n):
+    conf_fn = httpd_tree_fixture(tmp_dir, n)
+    return lambda: ApacheConfigList().recurse(conf_fn), ()
+
+
+CASES = [
+    ('clean_body', 'line', 1,
+     lambda tmp_dir, n: (clean_body, (iptables_fixture(n),))),
+    ('ApacheNode._parse', 'line', 1,
+     lambda tmp_dir, n: (ApacheNode.parse_string, (httpd_fixture(n),))),
+    ('ApacheConfigList', 'file', 100, setup_apache_list),
+    ('IPTables._parse', 'rule', 1,
+     lambda tmp_dir, n: (IPTables._parse, (iptables_fixture(n),))),
+    ('Services (lsof)', 'file', 1,
+     lambda tmp_dir, n: (Services._get_lsof_services, (lsof_fixture(n),))),
+    ('Services (/proc)', 'socket', 10,
+     lambda tmp_dir, n: (Services._get_proc_services,
+                         (proc_fixture(tmp_dir, n),))),
+    ('Interfaces (ifconfig)', 'iface', 1,
+     lambda tmp_dir, n: (Interfaces._get_ifconfig_interfaces,
+                         (ifconfig_fixture(n),))),
+    ('RPMs (rpmpkgs)', 'package', 1,
+     lambda tmp_dir, n: (RPMs._read_rpmpkgs, (write_fixture(
+         tmp_dir, 'rpmpkgs', rpmpkgs_fixture(n)),))),
+    ('RPMSnapshot.diff', 'package', 1, setup_rpm_diff),
+    ('SSHConfig.parse', 'line', 1,
+     lambda tmp_dir, n: (SSHConfig.parse, (write_fixture(
+         tmp_dir, 'sshd_config', sshd_config_fixture(n)),))),
+    ('INIConfig (my.cnf)', 'line', 1, setup_ini),
+]
+
+
+## Measurement.
+
+def current_rss():
+    """Return the current resident set size (in KiB)."""
+    try:
+        statm = open('/proc/self/statm', 'r')
+        try:
+            pages = int(statm.read().split()[1])
+        finally:
+            statm.close()
+        return pages * resource.getpagesize() / 1024
+    except (IOError, OSError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def measure(setup, n):
+    """
+    Set up and run a case; return the best wall time (in seconds) of three
+    runs and the peak RSS growth (in KiB) of the first run.
+    """
+    tmp_dir = tempfile.mkdtemp(prefix='secinv-bench-')
+    try:
+        func, args = setup(tmp_dir, n)
+
+        rss_before = current_rss()
+        best = None
+        for i in range(3):
+            start = time.time()
+            func(*args)
+            elapsed = time.time() - start
+            if best is None or elapsed < best:
+                best = elapsed
+            if i == 0:
+                peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - \
+                       rss_before
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    return best, max(0, peak)
+
+
+def measure_in_child(setup, n):
+    """Run `measure` in a forked child so peak RSS is per case."""
+    r, w = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(r)
+        try:
+            # Keep collector notices out of the report.
+            sys.stdout = open(os.devnull, 'w')
+            os.write(w, '%r %r' % measure(setup, n))
+        finally:
+            os._exit(0)
+
+    os.close(w)
+    data = ''
+    while True:
+        chunk = os.read(r, 4096)
+        if not chunk:
+            break
+        data += chunk
+    os.close(r)
+    os.waitpid(pid, 0)
+
+    if not data:
+        return None, None
+    elapsed, peak = data.split()
+    return float(elapsed), int(peak)
+
+
+def exponent(results):
+    """Return the scaling exponent between the smallest and largest size."""
+    (n1, t1), (n2, t2) = results[0], results[-1]
+    if n1 == n2 or t1 <= 0 or t2 <= 0:
+        return None
+    return math.log(t2 / t1) / math.log(float(n2) / n1)
+
+
+def load_baseline(fn):
+    baseline = {}
+    f = open(fn, 'r')
+    try:
+        for line in f:
+            ls = line.rstrip('\n').split('\t')
+            if len(ls) == 4:
+                baseline[(ls[0], int(ls[1]))] = float(ls[2])
+    finally:
+        f.close()
+    return baseline
+
+
+def run(cases, sizes, baseline=None):
+    """Run and report cases; return a list of (case, n, time, peak)."""
+    rows = []
+
+    for name, unit, divisor, setup in cases:
+        print name
+        results = []
+
+        for size in sizes:
+            n = max(1, size / divisor)
+            elapsed, peak = measure_in_child(setup, n)
+            if elapsed is None:
+                print '  %8d %-7s  failed' % (n, unit + 's')
+                continue
+
+            results.append((n, elapsed))
+            rows.append((name, n, elapsed, peak))
+
+            line = '  %8d %-7s  %8.3f s  %8.2f us/%-7s  %8d KiB peak' % (
+                n, unit + 's', elapsed, elapsed * 1e6 / n, unit, peak)
+            if baseline and (name, n) in baseline and baseline[(name, n)]:
+                line += '  %5.2fx baseline' % (elapsed / baseline[(name, n)])
+            print line
+
+        if len(results) > 1 and exponent(results) is not None:
+            print '  scaling ~ n^%.2f' % exponent(results)
+
+    return rows
+
+
+## ApacheNode tree memory.
+
+class DictNode:
+    """
+    Copy of an `ApacheNode` tree in the representation that preceded
+    `__slots__`, the baseline of `bench_apache_memory`: an instance
+    dictionary per node, a name string per directive (not interned), list
+    values, a children list on every node and parent pointers.
+    """
+    def __init__(self, node, parent=None):
+        # Slicing copies the interned name.
+        self.name = node.name[:1] + node.name[1:]
+        self.children = [DictNode(child, self) for child in node.children]
+        self.values = list(node.values)
+        self.section = node.section
+        self.parent = parent
+        self._child_index = None
+        self._descendant_index = None
+
+
+def tree_size(root):
+    """
+    Return the approximate memory (in bytes) held by a tree of nodes:
+    the nodes, their attribute dictionaries (if any), child containers,
+    values and strings. Shared objects (e.g., interned names) are counted
+    once.
+    """
+    seen = {}
+    size = 0
+    stack = [root]
+
+    while stack:
+        node = stack.pop()
+        objs = [node, node.children, node.values, node.name]
+        objs += list(node.values)
+        if hasattr(node, '__dict__'):
+            objs.append(node.__dict__)
+
+        for obj in objs:
+            if id(obj) not in seen:
+                seen[id(obj)] = obj
+                size += sys.getsizeof(obj)
+
+        stack.extend(node.children)
+
+    return size
+
+
+def count_nodes(root):
+    count = 0
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        count += 1
+        stack.extend(node.children)
+    return count - 1
+
+
+def bench_apache_memory(directives):
+    print 'ApacheNode tree memory'
+    # Each virtual host in the fixture is four nodes over eight lines.
+    body = httpd_fixture(2 + directives / 4 * 8)
+    root = ApacheNode.parse_string(body)
+    nodes = count_nodes(root)
+
+    for name, tree in (('dict', DictNode(root)), ('__slots__', root)):
+        size = tree_size(tree)
+        print '  %-10s %8d directives  %8.1f KiB  %6.1f bytes/node' % (
+            name, nodes, size / 1024.0, float(size) / nodes)
+
+
+## Payload encodings: (name, encode(inventory), decode(data)).
+
+ENCODINGS = [
+    ('xmlrpclib', lambda inventory: xmlrpclib.dumps((inventory,), 'machine'),
+     xmlrpclib.loads),
+    ('xmlrpclib+gzip',
+     lambda inventory: gzip_encode(xmlrpclib.dumps((inventory,), 'machine')),
+     lambda data: xmlrpclib.loads(gzip_decode(data))),
+    ('json', lambda inventory: encode_request('machine', (inventory,)),
+     decode_request),
+    ('json+zlib',
+     lambda inventory: zlib.compress(encode_request('machine', (inventory,)),
+                                     6),
+     lambda data: decode_request(zlib.decompress(data))),
+]
+
+
+def best_time(func, *args):
+    """Return the best wall time of three calls and the last result."""
+    best = None
+    for i in range(3):
+        start = time.time()
+        result = func(*args)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, result
+
+
+def bench_encoding(scale):
+    """
+    Compare encode/decode time and size of the payload encodings on a
+    synthetic inventory (and its Apache and RPM sections on their own).
+    """
+    print 'Payload encoding (scale %d)' % scale
+    inventory = synthetic_inventory(scale)
+    payloads = [('inventory', inventory),
+                ('apache', {'apache': inventory['apache']}),
+                ('rpms', {'rpms': inventory['rpms']})]
+
+    for payload_name, payload in payloads:
+        print '  %s' % payload_name
+        for name, encode, decode in ENCODINGS:
+            if name.startswith('json') and json is None:
+                continue
+            encode_time, data = best_time(encode, payload)
+            decode_time, result = best_time(decode, data)
+            print '    %-15s  encode %8.1f ms  decode %8.1f ms  %10d bytes' % (
+                name, encode_time * 1000, decode_time * 1000, len(data))
+
+
+## Agent startup.
+
+# Each snippet runs in a fresh interpreter started in this directory.
+STARTUP_CASES = [
+    ('interpreter', 'pass'),
+    ('import', 'import agent, collectors, transport'),
+    ('import inventory', 'import inventory'),
+    ('empty run', '; '.join([
+        'import xmlrpclib',
+        'from agent import Agent',
+        'from common import config',
+        'from transport import CompressedTransport',
+        'config.load()',
+        'proxy = xmlrpclib.ServerProxy("%s:%s" % (config.HOST, config.PORT), '
+        'transport=CompressedTransport())',
+        'Agent(proxy, {}).collect([])'])),
+]
+
+
+def bench_startup(runs):
+    """
+    Report the best wall time of `runs` fresh interpreters for importing
+    the agent and for an empty run (configuration loaded, agent built, no
+    collectors due).
+    """
+    print 'Agent startup'
+    for name, code in STARTUP_CASES:
+        best = None
+        for i in range(runs):
+            start = time.time()
+            status = subprocess.call([sys.executable, '-c', code], cwd=ROOT)
+            elapsed = time.time() - start
+            if status != 0:
+                best = None
+                break
+            if best is None or elapsed < best:
+                best = elapsed
+
+        if best is None:
+            print '  %-16s  failed' % name
+        else:
+            print '  %-16s  %8.1f ms' % (name, best * 1000)
+
+
+if __name__ == '__main__':
+    parser = OptionParser()
+    parser.add_option('--sizes', dest='sizes', default='1000,10000,100000',
+                      help='comma-separated fixture sizes')
+    parser.add_option('--cases', dest='cases', default='',
+                      help='comma-separated case names (default: all)')
+    parser.add_option('--apache-directives', dest='apache_directives',
+                      type='int', default=50000,
+                      help='directives in the ApacheNode memory fixture')
+    parser.add_option('--encoding-scale', dest='encoding_scale', type='int',
+                      default=10000, help='lines per section of the '
+                      'inventory encoded (0 to skip)')
+    parser.add_option('--startup-runs', dest='startup_runs', type='int',
+                      default=10, help='interpreters started per startup '
+                      'case (0 to skip)')
+    parser.add_option('--save-baseline', dest='save_baseline', default=None,
+                      help='write the results to a baseline file')
+    parser.add_option('--compare', dest='compare', default=None,
+                      help='compare wall times with a baseline file')
+    options, args = parser.parse_args()
+
+    sizes = [int(n) for n in options.sizes.split(',')]
+
+    cases = CASES
+    if options.cases:
+        names = [name.strip() for name in options.cases.split(',')]
+        cases = [case for case in CASES if case[0] in names]
+
+    baseline = None
+    if options.compare:
+        baseline = load_baseline(options.compare)
+
+    rows = run(cases, sizes, baseline)
+    bench_apache_memory(options.apache_directives)
+    if options.encoding_scale:
+        bench_encoding(options.encoding_scale)
+    if options.startup_runs:
+        bench_startup(options.startup_runs)
+
+    if options.save_baseline:
+        f = open(options.save_baseline, 'w')
+        try:
+            for row in rows:
+                f.write('%s\t%d\t%r\t%d\n' % row)
+        finally:
+            f.close()
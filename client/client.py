@@ -1,50 +1,72 @@
 #!/usr/bin/env python
-import xmlrpclib
+from optparse import OptionParser
 import sys
 
+from agent import Agent, UPLOAD_ERRORS
+from collectors import get_enabled, register_defaults
 from common import *
-from inventory import *
-
-proxy = xmlrpclib.ServerProxy(uri="%s:%s" % (HOST, PORT), verbose=False)
-
-multicall = xmlrpclib.MultiCall(proxy)
-
-# Send authentication key.
-multicall.authenticate(AUTH_TOKEN)
-
-
-ip = Interfaces()
-ip_dict = ip.get_interfaces()
-
-system = System()
-system_dict = system.get_system_dict()
-
-services = Services()
-services_dict = services.get_services()
-
-rpms = RPMs()
-rpms_dict = rpms.get_rpms()
-
-cp = SSHConfig()
-sshconfig_dict = cp.parse()
-
-ipt = IPTables()
-ipt_dict = ipt.get_ipt_dict()
-
-acl = ApacheConfigList()
-acl_list = acl.get_apache_configs()
-
-phpini = PHPConfig()
-phpini_dict = phpini.parse()
-
-mycnf = MySQLConfig()
-mycnf_dict = mycnf.parse()
-
-
-multicall.machine(ip_dict, system_dict, services_dict, rpms_dict,
-                  sshconfig_dict, ipt_dict, acl_list, phpini_dict, mycnf_dict)
-result = multicall()
-
-print "Authentication:  %s" % result[0]
-print "Received machine info:  %s" % result[1]
-
+from compact import CompactServerProxy
+from transport import CompressedTransport
+
+parser = OptionParser()
+parser.add_option('--full', action='store_true', dest='full', default=False,
+                  help='send every inventory section (full resync)')
+parser.add_option('--daemon', action='store_true', dest='daemon',
+                  default=False, help='keep running and collect each section '
+                  'on its own interval (see [schedule] in settings.conf)')
+parser.add_option('--no-splay', action='store_true', dest='no_splay',
+                  default=False, help='start at once instead of waiting a '
+                  'random time (see splay in settings.conf)')
+parser.add_option('--profile', action='store_true', dest='profile',
+                  default=False, help='print per-collector timings and '
+                  'resource usage')
+parser.add_option('--profile-dump', dest='profile_dump', default=None,
+                  metavar='FILE', help='run the collectors one at a time '
+                  'under cProfile and write the stats to FILE')
+options, args = parser.parse_args()
+
+try:
+    config.load()
+except ConfigError, error:
+    sys.exit("Error: %s" % error)
+
+transport = CompressedTransport(secure=config.HOST.startswith('https'))
+proxy = CompactServerProxy("%s:%s" % (config.HOST, config.PORT), transport)
+
+register_defaults()
+collectors = get_enabled()
+
+metrics = None
+if options.profile or config.SEND_METRICS:
+    from metrics import Metrics
+    metrics = Metrics()
+
+splay = None
+if options.no_splay or options.profile_dump:
+    splay = 0
+
+agent = Agent(proxy, collectors, full=options.full, metrics=metrics,
+              splay=splay)
+
+if options.daemon:
+    agent.run_forever()
+else:
+    if options.profile_dump:
+        import cProfile
+
+        # cProfile only sees the calling thread.
+        agent.workers = 1
+        profiler = cProfile.Profile()
+        result = profiler.runcall(agent.run_once)
+        profiler.dump_stats(options.profile_dump)
+    else:
+        try:
+            result = agent.run_once()
+        except UPLOAD_ERRORS, error:
+            sys.exit("Error: Cannot upload inventory: %s" % error)
+
+    print "Authentication:  %s" % result[0]
+    print "Received machine info:  %s" % result[1]
+
+    if options.profile:
+        print metrics.report()
@@ -0,0 +1,188 @@
+import os
+
+from common import *
+
+
+# Cost classes, cheapest first. Within a round the most expensive collectors
+# are started first, so the cheap ones fill in around them.
+COSTS = ('low', 'medium', 'high')
+
+
+class Collector:
+    """
+    An inventory collector: calling `func` returns the payload section
+    `name`.
+
+    `cost` is one of `COSTS` and `interval` the default number of seconds
+    between runs in daemon mode (`[schedule]` in `settings.conf` overrides
+    it). `requires` names collectors that must run before this one in the
+    same round.
+
+    `watch` optionally takes the collector's result and returns the (files,
+    directories) it was read from. `snapshot` is an optional object (e.g.,
+    an `RPMSnapshot`) that is loaded when the agent starts, turns the
+    result into the section sent (`build`), and is committed after every
+    successful push.
+
+    If `dedup`, the result is a config section whose file bodies are sent
+    by digest to servers that offer it (see `dedup.py`).
+    """
+    def __init__(self, name, func, cost='medium', interval=3600, requires=(),
+                 watch=None, snapshot=None, dedup=False):
+        if cost not in COSTS:
+            raise ValueError("Unknown cost class '%s' for collector '%s'"
+                             % (cost, name))
+        self.name = name
+        self.func = func
+        self.cost = cost
+        self.interval = interval
+        self.requires = tuple(requires)
+        self.watch = watch
+        self.snapshot = snapshot
+        self.dedup = dedup
+
+    def __call__(self):
+        return self.func()
+
+    def __repr__(self):
+        return '<Collector %s (%s)>' % (self.name, self.cost)
+
+
+class Lazy:
+    """
+    Stand-in for an attribute of a module (e.g., `'inventory.RPMs.get_rpms'`)
+    that imports the module when first used, so the collectors' modules are
+    only loaded once an enabled collector needs them. Calling it calls the
+    attribute; with `args`, the attribute (a class) is instantiated with
+    them and attributes are looked up on the instance.
+    """
+    def __init__(self, target, args=None):
+        self.target = target
+        self.args = args
+        self.value = None
+
+    def get(self):
+        if self.value is None:
+            module_name, attrs = self.target.split('.', 1)
+            value = __import__(module_name)
+            for attr in attrs.split('.'):
+                value = getattr(value, attr)
+            if self.args is not None:
+                value = value(*self.args)
+            self.value = value
+        return self.value
+
+    def __call__(self, *args, **kwargs):
+        return self.get()(*args, **kwargs)
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return getattr(self.get(), name)
+
+
+# Registered collectors: {name: Collector}.
+registry = {}
+
+
+def register(collector):
+    """Add (or replace) a collector in the registry and return it."""
+    registry[collector.name] = collector
+    return collector
+
+
+def register_defaults():
+    """
+    Register the built-in collectors, plus one for each `[ini]` entry in
+    `settings.conf`. `inventory` is imported when one of them first runs.
+    """
+    register(Collector('interfaces',
+                       Lazy('inventory.Interfaces.get_interfaces'), 'low', 300))
+    register(Collector('system', Lazy('inventory.System.get_system_dict'),
+                       'medium', 3600))
+    register(Collector('services', Lazy('inventory.Services.get_services'),
+                       'high', 300))
+
+    # The package list is sent as changes since the last successful upload.
+    # Only `Packages` is watched: Berkeley DB rewrites the `__db.*` region
+    # files in the same directory even when the database is only read.
+    register(Collector('rpms', Lazy('inventory.RPMs.get_rpms'), 'high', 86400,
+                       snapshot=Lazy('inventory.RPMSnapshot', ()),
+                       watch=lambda result: ([config.RPM_PKGS,
+                                              os.path.join(config.RPM_DB,
+                                                           'Packages')],
+                                             [])))
+
+    register(Collector('sshd', Lazy('inventory.SSHConfig.parse'), 'low', 3600,
+                       watch=lambda result: ([config.SSH_CONFIG_FILE], []),
+                       dedup=True))
+    register(Collector('iptables', Lazy('inventory.IPTables.get_ipt_dict'),
+                       'medium', 900))
+    apache = Lazy('inventory.ApacheConfigList')
+    register(Collector('apache', lambda: apache().get_apache_configs(),
+                       'high', 86400,
+                       watch=lambda result: apache.get_watch_paths(result),
+                       dedup=True))
+
+    for name, (filename, scan_dirs) in config.INI_FILES.iteritems():
+        ini = Lazy('inventory.INIConfig', (filename, scan_dirs))
+        register(Collector(name, lambda ini=ini: ini.parse(), 'low', 86400,
+                           watch=lambda result, ini=ini:
+                               ini.get_watch_paths(result),
+                           dedup=True))
+
+
+def get_enabled():
+    """
+    Return the registered collectors turned on in `[collectors]` (those
+    not listed are on) as {name: Collector}, with their intervals taken
+    from `[schedule]` where set. Collectors that require a disabled or
+    unknown collector are turned off as well.
+    """
+    for name in config.COLLECTORS.keys() + config.SCHEDULE.keys():
+        if name not in registry:
+            print "Notice: Unknown collector '%s' in settings" % name
+
+    enabled = {}
+    for name, collector in registry.iteritems():
+        if config.COLLECTORS.get(name, True):
+            collector.interval = config.SCHEDULE.get(name, collector.interval)
+            enabled[name] = collector
+
+    changed = True
+    while changed:
+        changed = False
+        for name, collector in enabled.items():
+            missing = [r for r in collector.requires if r not in enabled]
+            if missing:
+                print "Notice: Collector '%s' is off (requires '%s')" % (
+                    name, "', '".join(missing))
+                del enabled[name]
+                changed = True
+
+    return enabled
+
+
+def stages(collectors, names):
+    """
+    Order the named collectors into stages: every collector comes after
+    those it requires (of the ones named), and each stage lists the most
+    expensive collectors first. Returns a list of lists of names.
+    """
+    rank = lambda name: (-COSTS.index(collectors[name].cost), name)
+    remaining = dict([(name, True) for name in names])
+    result = []
+
+    while remaining:
+        stage = [name for name in remaining
+                 if not [r for r in collectors[name].requires
+                         if r in remaining]]
+        if not stage:
+            raise ValueError("Collector dependency cycle among '%s'"
+                             % "', '".join(remaining.keys()))
+        stage.sort(key=rank)
+        result.append(stage)
+        for name in stage:
+            del remaining[name]
+
+    return result
@@ -0,0 +1,221 @@
+import errno
+import os
+import select
+import shlex
+import signal
+import subprocess
+import threading
+import time
+
+from common import *
+from metrics import CountedPopen
+
+
+class CommandError(Exception):
+    """A command timed out or its output exceeded the cap."""
+
+
+class CommandResult:
+    """Output and exit status of a command run by `run`."""
+    def __init__(self, output='', returncode=None):
+        self.output = output
+        self.returncode = returncode
+
+
+# Results of the commands run in the current collection round.
+_cache = {}
+_cache_lock = threading.Lock()
+
+
+def clear_cache():
+    """Forget cached command results (at the start of a collection round)."""
+    _cache_lock.acquire()
+    try:
+        _cache.clear()
+    finally:
+        _cache_lock.release()
+
+
+def _start(argv):
+    """
+    Start `argv` with its standard output piped, in a session (and process
+    group) of its own if `setsid` is available. Return the process, or None
+    if it cannot be run.
+
+    The session is created by exec'ing `setsid` rather than with a
+    `preexec_fn`: running Python code between `fork` and `exec` can deadlock
+    while collectors start commands from several threads.
+    """
+    group = bool(config.SETSID) and os.access(config.SETSID, os.X_OK)
+    if group:
+        # Otherwise `setsid` itself would report a missing command.
+        if os.path.isabs(argv[0]) and not os.access(argv[0], os.X_OK):
+            print "Notice: Cannot run '%s': %s" % (
+                ' '.join(argv), os.strerror(errno.ENOENT))
+            return None
+        exec_argv = (config.SETSID,) + argv
+    else:
+        exec_argv = argv
+
+    try:
+        proc = CountedPopen(exec_argv, stdout=subprocess.PIPE, close_fds=True)
+    except OSError, error:
+        print "Notice: Cannot run '%s': %s" % (' '.join(argv), error.strerror)
+        return None
+
+    # `setsid` execs the command in place (it is not a group leader), so the
+    # command's pid is also its process group id.
+    proc.group = group
+    return proc
+
+
+def _kill(proc):
+    """Kill the process group started for `proc` (or just `proc`)."""
+    try:
+        if proc.group:
+            os.killpg(proc.pid, signal.SIGKILL)
+        else:
+            os.kill(proc.pid, signal.SIGKILL)
+    except OSError:
+        pass
+
+
+def _iter_output(proc, argv, timeout, max_output):
+    """
+    Generate chunks of standard output until EOF. Raise `CommandError` once
+    `timeout` seconds pass or more than `max_output` bytes are read.
+    """
+    fd = proc.stdout.fileno()
+    deadline = time.time() + timeout
+    size = 0
+
+    while True:
+        remaining = deadline - time.time()
+        readable = None
+        if remaining > 0:
+            try:
+                readable = select.select([fd], [], [], remaining)[0]
+            except select.error, error:
+                if error.args[0] == errno.EINTR:
+                    continue
+                raise
+
+        if not readable:
+            raise CommandError("'%s' timed out after %g seconds"
+                               % (' '.join(argv), timeout))
+
+        data = os.read(fd, 65536)
+        if not data:
+            return
+
+        size += len(data)
+        if size > max_output:
+            raise CommandError("'%s' output exceeded %d bytes"
+                               % (' '.join(argv), max_output))
+        yield data
+
+
+def _wait(proc, deadline):
+    """Wait for `proc` to exit until the deadline; return its exit status."""
+    while proc.poll() is None:
+        if time.time() >= deadline:
+            _kill(proc)
+            return proc.wait()
+        time.sleep(0.01)
+    return proc.returncode
+
+
+def _argv(cmd, args):
+    return tuple(shlex.split(cmd) + list(args))
+
+
+class OutputLines:
+    """
+    Run a command like `run`, but iterate over its output line by line as
+    it is read (nothing is cached). Iterating raises `CommandError` if the
+    command times out or its output exceeds the cap; `close` kills it if
+    its output was not read to the end.
+    """
+    def __init__(self, cmd, *args, **kwargs):
+        self.timeout = kwargs.get('timeout', config.COMMAND_TIMEOUT)
+        self.max_output = kwargs.get('max_output', config.COMMAND_MAX_OUTPUT)
+        self.argv = _argv(cmd, args)
+        self.proc = _start(self.argv)
+        self.complete = False
+
+    def __iter__(self):
+        if self.proc is None:
+            return iter(())
+        return self._lines()
+
+    def _lines(self):
+        rest = ''
+        for data in _iter_output(self.proc, self.argv, self.timeout,
+                                 self.max_output):
+            lines = (rest + data).split('\n')
+            rest = lines.pop()
+            for line in lines:
+                yield '%s\n' % line
+        if rest:
+            yield rest
+        self.complete = True
+
+    def close(self):
+        if self.proc is None:
+            return
+        if not self.complete:
+            _kill(self.proc)
+        self.proc.stdout.close()
+        _wait(self.proc, time.time() + self.timeout)
+        self.proc = None
+
+
+def run(cmd, *args, **kwargs):
+    """
+    Run a command without a shell and return a `CommandResult`.
+
+    `cmd` is a command line from `settings.conf` (split like a shell would,
+    e.g., `/sbin/iptables-save -c`) and `args` are extra arguments. The
+    command runs in its own process group, which is killed (and
+    `CommandError` raised, so that the collector fails rather than sending
+    partial output) once `timeout` seconds pass or more than `max_output`
+    bytes of output are read. Results are cached (per argument list) until
+    `clear_cache` is called.
+    """
+    timeout = kwargs.get('timeout', config.COMMAND_TIMEOUT)
+    max_output = kwargs.get('max_output', config.COMMAND_MAX_OUTPUT)
+
+    argv = _argv(cmd, args)
+
+    _cache_lock.acquire()
+    try:
+        if argv in _cache:
+            return _cache[argv]
+    finally:
+        _cache_lock.release()
+
+    proc = _start(argv)
+    if proc is None:
+        return CommandResult(returncode=127)
+
+    deadline = time.time() + timeout
+    try:
+        try:
+            output = ''.join(list(_iter_output(proc, argv, timeout,
+                                               max_output)))
+        except CommandError:
+            _kill(proc)
+            raise
+    finally:
+        proc.stdout.close()
+        returncode = _wait(proc, deadline)
+
+    result = CommandResult(output, returncode)
+
+    _cache_lock.acquire()
+    try:
+        _cache[argv] = result
+    finally:
+        _cache_lock.release()
+
+    return result
@@ -1,7 +1,8 @@
-from ConfigParser import ConfigParser
+from ConfigParser import ConfigParser, Error as ConfigParserError
+import cStringIO
 import os
 import re
-import sys
+import threading
 
 ROOT = os.path.dirname(os.path.abspath(__file__))
 
@@ -17,87 +18,206 @@ warnings.filterwarnings('ignore')
 AUTH_CONFIG_FN = path('auth.conf')
 CLIENT_CONFIG_FN = path('settings.conf')
 
-client_config = auth_config = ConfigParser()
 
-try:
-    client_config.readfp(file(CLIENT_CONFIG_FN))
-except IOError:
-    sys.exit("Error: Cannot open inventory configuration file '%s'"
-             % CLIENT_CONFIG_FN)
+class ConfigError(Exception):
+    pass
 
-try:
-    auth_config.readfp(file(AUTH_CONFIG_FN))
-except IOError:
-    sys.exit("Error: Cannot open inventory authorization token file '%s'"
-             % AUTH_CONFIG_FN)
 
+def _bool(value):
+    return value.lower() == 'true' and True or False
 
-## Server.
-HOST = client_config.get('server', 'host')
-PORT = client_config.get('server', 'port')
-AUTH_TOKEN = auth_config.get('auth_token', 'auth_token')
-DEBUG = client_config.get('server', 'debug').lower() == 'true' and True or False
 
+def _list(value):
+    return [f.strip() for f in re.split(',', value) if f.strip()]
 
-## Paths.
-RH_RELEASE = os.path.abspath(client_config.get('paths', 'rh_release'))
-IP_FORWARD = os.path.abspath(client_config.get('paths', 'ip_forward'))
-RPM_PKGS = os.path.abspath(client_config.get('paths', 'rpm_pkgs'))
-SSH_CONFIG_FILE = os.path.abspath(client_config.get('paths', 'ssh_config_file'))
-IPTABLES = client_config.get('paths', 'iptables')
-PHP_INI = client_config.get('paths', 'php_ini')
-MY_CNF = client_config.get('paths', 'my_cnf')
 
-IFCONFIG = client_config.get('paths', 'ifconfig')
-HOSTNAME = client_config.get('paths', 'hostname')
-UNAME = client_config.get('paths', 'uname')
-MOUNT = client_config.get('paths', 'mount')
-LSOF = client_config.get('paths', 'lsof')
-IPTABLES = client_config.get('paths', 'iptables')
-IPTABLES_SAVE = client_config.get('paths', 'iptables_save')
-
-
-## Apache.
-APACHE_ROOT = os.path.abspath(client_config.get('apache', 'server_root'))
-APACHE_CONF = os.path.abspath(client_config.get('apache', 'conf_file'))
-
-APACHE_IGNORE_DIRECTIVES = [f.strip() for f in \
-    re.split(',', client_config.get('apache', 'ignore_directives'))]
-
-
-## Miscellaneous.
-PARSE_CONF_COMMENTS = client_config.get('miscellaneous',
-    'parse_conf_comments').lower() == 'true' and True or False
-
-
-def clean_body(body, comments_prefix='#'):
+class Config(object):
     """
-    Clean up whitespace, multiline instructions, and comments (if applicable).
+    Client settings from `settings.conf` and the token from `auth.conf`.
+
+    Nothing is read until a setting is first looked up (e.g.,
+    `config.HOST`), so importing a module costs no file access and a bad
+    configuration surfaces as a `ConfigError` where it is used instead of
+    exiting at import time.
+
+    The client shares one instance, `config`, rather than passing one to
+    every collector: collectors are plain functions and class methods
+    called with no arguments by the runner, and take their files as
+    optional arguments (defaulting to `config`) where callers such as
+    `benchmark.py` need to substitute their own.
+    """
+    def __init__(self, client_fn=CLIENT_CONFIG_FN, auth_fn=AUTH_CONFIG_FN):
+        self.client_fn = client_fn
+        self.auth_fn = auth_fn
+        self._lock = threading.Lock()
+        self._loaded = False
+
+    def __getattr__(self, name):
+        # Only called for settings that have not been loaded yet.
+        if name.startswith('_') or self._loaded:
+            raise AttributeError(name)
+        self.load()
+        return getattr(self, name)
+
+    def _read(self, parser, filename, description):
+        try:
+            parser.readfp(file(filename))
+        except IOError:
+            raise ConfigError("Cannot open inventory %s '%s'"
+                              % (description, filename))
+
+    def load(self):
+        """Read both files (once) and set every setting as an attribute."""
+        self._lock.acquire()
+        try:
+            if self._loaded:
+                return
+
+            client_config = ConfigParser()
+            auth_config = ConfigParser()
+            self._read(client_config, self.client_fn, 'configuration file')
+            self._read(auth_config, self.auth_fn, 'authorization token file')
+
+            try:
+                self._set(client_config, auth_config)
+            except (ConfigParserError, ValueError), error:
+                raise ConfigError("Invalid inventory configuration file "
+                                  "'%s': %s" % (self.client_fn, error))
+
+            self._loaded = True
+        finally:
+            self._lock.release()
+
+    def _set(self, client_config, auth_config):
+        get = client_config.get
+
+        ## Server.
+        self.HOST = get('server', 'host')
+        self.PORT = get('server', 'port')
+        self.AUTH_TOKEN = auth_config.get('auth_token', 'auth_token')
+        self.DEBUG = _bool(get('server', 'debug'))
+        self.SERVER_TIMEOUT = float(get('server', 'timeout'))
+        self.SERVER_COMPRESS = _bool(get('server', 'compress'))
+        self.SERVER_COMPRESS_THRESHOLD = int(get('server', 'compress_threshold'))
+        self.SERVER_ENCODING = get('server', 'encoding').lower()
+
+        ## Paths.
+        self.RH_RELEASE = os.path.abspath(get('paths', 'rh_release'))
+        self.IP_FORWARD = os.path.abspath(get('paths', 'ip_forward'))
+        self.RPM_PKGS = os.path.abspath(get('paths', 'rpm_pkgs'))
+        self.RPM_DB = os.path.abspath(get('paths', 'rpm_db'))
+        self.SSH_CONFIG_FILE = os.path.abspath(get('paths', 'ssh_config_file'))
+        self.SYS_CLASS_NET = get('paths', 'sys_class_net')
+        self.IF_INET6 = get('paths', 'if_inet6')
+        self.PROC = get('paths', 'proc')
+
+        self.IFCONFIG = get('paths', 'ifconfig')
+        self.HOSTNAME = get('paths', 'hostname')
+        self.UNAME = get('paths', 'uname')
+        self.MOUNT = get('paths', 'mount')
+        self.LSOF = get('paths', 'lsof')
+        self.IPTABLES = get('paths', 'iptables')
+        self.IPTABLES_SAVE = get('paths', 'iptables_save')
+        self.SETSID = get('paths', 'setsid')
+
+        ## INI-style configuration files: {name: (file, [scan directories])}.
+        self.INI_FILES = {}
+        for name, value in client_config.items('ini'):
+            ls = _list(value)
+            if not ls:
+                raise ValueError("No file for '%s' in [ini]" % name)
+            self.INI_FILES[name] = (ls[0], ls[1:])
+
+        ## Apache.
+        self.APACHE_ROOT = os.path.abspath(get('apache', 'server_root'))
+        self.APACHE_CONF = os.path.abspath(get('apache', 'conf_file'))
+        self.APACHE_IGNORE_DIRECTIVES = _list(get('apache', 'ignore_directives'))
+
+        ## Miscellaneous.
+        self.PARSE_CONF_COMMENTS = _bool(get('miscellaneous', 'parse_conf_comments'))
+        self.WORKER_THREADS = int(get('miscellaneous', 'worker_threads'))
+        self.SERVICES_BACKEND = get('miscellaneous', 'services_backend').lower()
+        self.COMMAND_TIMEOUT = float(get('miscellaneous', 'command_timeout'))
+        self.COMMAND_MAX_OUTPUT = int(get('miscellaneous', 'command_max_output'))
+        self.COLLECTOR_RETRY = float(get('miscellaneous', 'collector_retry'))
+        self.SEND_METRICS = _bool(get('miscellaneous', 'send_metrics'))
+
+        ## Collectors turned on or off.
+        self.COLLECTORS = {}
+        for name, value in client_config.items('collectors'):
+            self.COLLECTORS[name] = _bool(value)
+
+        ## Daemon mode: seconds between runs of each collector.
+        self.SCHEDULE = {}
+        for name, interval in client_config.items('schedule'):
+            self.SCHEDULE[name] = int(interval)
+
+        ## Daemon mode: re-run collectors when the files they read change.
+        self.WATCH_ENABLED = _bool(get('watch', 'enabled'))
+        self.WATCH_POLL_INTERVAL = float(get('watch', 'poll_interval'))
+
+        ## Uploads: start splay, retries with backoff, and the spool.
+        self.SPLAY = float(get('upload', 'splay'))
+        self.RETRIES = int(get('upload', 'retries'))
+        self.BACKOFF_BASE = float(get('upload', 'backoff_base'))
+        self.BACKOFF_MAX = float(get('upload', 'backoff_max'))
+        self.SPOOL_DIR = get('upload', 'spool_dir')
+        self.SPOOL_MAX_FILES = int(get('upload', 'spool_max_files'))
+        self.SPOOL_MAX_BYTES = int(get('upload', 'spool_max_bytes'))
+        self.SPOOL_COLLAPSE = _bool(get('upload', 'spool_collapse'))
+        self.SECTION_DIR = get('upload', 'section_dir')
+        self.CHUNKED = _bool(get('upload', 'chunked'))
+        self.CHUNK_SIZE = int(get('upload', 'chunk_size'))
+        self.DEDUP = _bool(get('upload', 'dedup'))
+        self.DEDUP_MIN_SIZE = int(get('upload', 'dedup_min_size'))
+
+        ## Delta reporting.
+        self.DELTA_ENABLED = _bool(get('delta', 'enabled'))
+        self.DELTA_STATE_FILE = get('delta', 'state_file')
+        self.RPM_SNAPSHOT_FILE = get('delta', 'rpm_snapshot_file')
+
+
+# The configuration shared by the client and its collectors.
+config = Config()
+
+
+def clean_lines(lines, comments_prefix='#'):
+    """
+    Generate stripped lines with blank lines and comments (if applicable)
+    removed and multiline instructions (delimited by backslash-newlines)
+    joined. `lines` is any iterable of lines (e.g., an open file) or a
+    string; it is consumed in a single pass and never modified.
     """
     if not type(comments_prefix) in (tuple, list, str):
         raise TypeError
 
-    if type(body) is list:
-        lines = body
-    else:
-        lines = re.split('\n', body)
+    if isinstance(lines, basestring):
+        lines = cStringIO.StringIO(lines)
 
-    body = ''
+    continued = None
 
-    for index, line in enumerate(lines):
+    for line in lines:
         line = line.strip()
 
-        if not line or (not PARSE_CONF_COMMENTS and line[0] in comments_prefix):
+        if continued is not None:
+            # Concatenate multiline instructions delimited by backslash-newlines.
+            line = ' '.join([continued, line])
+            continued = None
+        elif not line or (not config.PARSE_CONF_COMMENTS and line[0] in comments_prefix):
             continue
 
-        # Concatenate multiline instructions delimited by backslash-newlines.
         if line and line[-1] == '\\':
-            while line[-1] == '\\':
-                line = ' '.join([line[:-1].strip(),
-                                 lines[index + 1].strip()])
-                del lines[index + 1]
+            continued = line[:-1].strip()
+            continue
+
+        yield line
 
-        body += '%s\n' % line
+    if continued is not None:
+        yield continued
 
-    return body
 
+def clean_body(body, comments_prefix='#'):
+    """
+    Clean up whitespace, multiline instructions, and comments (if applicable).
+    """
+    return ''.join(['%s\n' % line for line in clean_lines(body, comments_prefix)])
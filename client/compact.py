@@ -0,0 +1,216 @@
+"""
+Compact wire encoding: XML-RPC calls carried as JSON (and deflated by the
+transport) instead of XML.
+
+A request body is `{"method": <name>, "params": [...]}` and a response body
+`{"result": <value>}` or `{"fault": {"faultCode": ..., "faultString": ...}}`,
+sent with `Content-Type: application/json`. Servers that accept it list
+`COMPACT` in the result of their `encodings` XML-RPC method.
+
+Servers that list `CHUNKED` accept an inventory streamed section by
+section in bounded chunks of its JSON encoding (in either encoding):
+
+    session_begin(auth_token) -> session id ('' if authentication fails)
+    session_chunk(session id, section name, chunk index, data, final)
+    session_commit(session id, metrics) -> result of `machine`
+    session_abort(session id)
+
+A section's chunks are numbered from 0 and concatenated by the server,
+which decodes the section once the `final` one arrives. A chunk received
+twice (e.g., a retried call) is ignored.
+"""
+import xmlrpclib
+
+try:
+    import json
+except ImportError:
+    # Python 2.4 and 2.5.
+    try:
+        import simplejson as json
+    except ImportError:
+        json = None
+
+from common import *
+
+
+# Names in `encodings()`, and the content type of compact requests.
+COMPACT = 'json'
+CHUNKED = 'chunked'
+CONTENT_TYPE = 'application/json'
+
+
+def dumps(value):
+    return json.dumps(value, separators=(',', ':'))
+
+
+def loads(data):
+    return json.loads(data)
+
+
+def encode_request(method, params):
+    """Return the body of a call to `method` with `params`."""
+    return dumps({'method': method, 'params': list(params)})
+
+
+def decode_request(data):
+    """Return the (params, method) of a call, like `xmlrpclib.loads`."""
+    request = loads(data)
+    return tuple(request['params']), request['method']
+
+
+def encode_response(result):
+    """Return the body of a response: a result or an `xmlrpclib.Fault`."""
+    if isinstance(result, xmlrpclib.Fault):
+        return dumps({'fault': {'faultCode': result.faultCode,
+                                'faultString': result.faultString}})
+    return dumps({'result': result})
+
+
+def decode_response(data):
+    """Return the result of a response; raise `xmlrpclib.Fault` for faults."""
+    response = loads(data)
+    if 'fault' in response:
+        raise xmlrpclib.Fault(response['fault']['faultCode'],
+                              response['fault']['faultString'])
+    return response['result']
+
+
+# Containers of at most this many items, none of them containers, are
+# encoded in one piece by `iter_encode` (e.g., one package or rule record).
+LEAF_ITEMS = 64
+
+
+def _leaf(value):
+    """Return whether container `value` is a small record of plain values."""
+    if len(value) > LEAF_ITEMS:
+        return False
+    if isinstance(value, dict):
+        value = value.itervalues()
+    for item in value:
+        if isinstance(item, (dict, list, tuple)):
+            return False
+    return True
+
+
+def iter_encode(value):
+    """
+    Generate the JSON encoding of `value` in pieces: dictionaries and lists
+    are encoded item by item, however deeply nested, down to small records
+    of plain values (see `LEAF_ITEMS`), so no piece is larger than one such
+    record or one string (e.g., one package, one iptables rule or one
+    Apache file). The encoding is ASCII.
+    """
+    if isinstance(value, dict) and not _leaf(value):
+        yield '{'
+        separator = ''
+        for key, item in value.iteritems():
+            if not isinstance(key, basestring):
+                # Like `json.dumps`, which turns keys into strings.
+                key = dumps(key)
+            yield '%s%s:' % (separator, dumps(key))
+            separator = ','
+            for piece in iter_encode(item):
+                yield piece
+        yield '}'
+    elif isinstance(value, (list, tuple)) and not _leaf(value):
+        yield '['
+        separator = ''
+        for item in value:
+            if separator:
+                yield separator
+            separator = ','
+            for piece in iter_encode(item):
+                yield piece
+        yield ']'
+    else:
+        yield dumps(value)
+
+
+def chunks(pieces, size):
+    """
+    Join and split string `pieces` into chunks of `size` bytes (the last
+    may be shorter); generate (chunk, final) pairs. Large pieces are cut
+    at an offset, so each byte is copied a bounded number of times.
+    """
+    buf = []
+    buf_len = 0
+    for piece in pieces:
+        offset = 0
+        while buf_len + len(piece) - offset > size:
+            end = offset + size - buf_len
+            buf.append(piece[offset:end])
+            offset = end
+            yield ''.join(buf), False
+            buf = []
+            buf_len = 0
+        if offset:
+            piece = piece[offset:]
+        buf.append(piece)
+        buf_len += len(piece)
+
+    yield ''.join(buf), True
+
+
+def split_uri(uri):
+    """Return the host and handler (path) of an XML-RPC server URI."""
+    scheme, rest = uri.split('://', 1)
+    if '/' in rest:
+        host, handler = rest.split('/', 1)
+        return host, '/' + handler
+    return rest, '/RPC2'
+
+
+class CompactServerProxy:
+    """
+    `xmlrpclib.ServerProxy` look-alike (it works with `xmlrpclib.MultiCall`)
+    that sends calls in the compact encoding when the server offers it.
+
+    The server is asked for its `encodings` before the first call; servers
+    without that method, `encoding=xmlrpc` in `settings.conf`, Pythons
+    without `json`, and calls with strings that are not valid UTF-8 all use
+    plain XML-RPC over the same `transport`.
+    """
+    def __init__(self, uri, transport, encoding=None):
+        if encoding is None:
+            encoding = config.SERVER_ENCODING
+        self.host, self.handler = split_uri(uri)
+        self.transport = transport
+        self.xmlrpc = xmlrpclib.ServerProxy(uri, transport=transport)
+        self.allow_compact = encoding != 'xmlrpc' and json is not None
+        self.offered = None
+        self.compact = False
+
+    def negotiate(self):
+        """Ask the server which encodings it accepts besides XML-RPC."""
+        try:
+            self.offered = self.xmlrpc.encodings()
+        except xmlrpclib.Fault:
+            # No `encodings` method.
+            self.offered = []
+        self.compact = self.allow_compact and COMPACT in self.offered
+
+    def offers(self, name):
+        """Return whether the server offers encoding (or protocol) `name`."""
+        if self.offered is None:
+            self.negotiate()
+        return name in self.offered
+
+    def _request(self, method, params):
+        if self.offered is None:
+            self.negotiate()
+
+        if self.compact:
+            try:
+                body = encode_request(method, params)
+            except UnicodeError:
+                body = None
+            if body is not None:
+                return decode_response(self.transport.raw_request(
+                    self.host, self.handler, body, CONTENT_TYPE))
+
+        return getattr(self.xmlrpc, method)(*params)
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return xmlrpclib._Method(self._request, name)
@@ -0,0 +1,99 @@
+"""
+Content-addressed configuration bodies: hosts that share a file (e.g., the
+same `httpd.conf` or `php.ini`) upload its body once for the whole fleet.
+
+Servers that list `DEDUP` in `encodings()` accept:
+
+    bodies_missing(auth_token, digests) -> the digests it does not have
+    bodies_put(auth_token, {digest: body})
+
+The client sends the SHA-256 digests (hex) of the bodies in its config
+sections, uploads the missing bodies, then sends the sections with each
+`body` replaced by `body_sha256` (with `machine` or a chunked session).
+The server keeps one copy of each body, so its storage and bandwidth grow
+with the number of distinct files rather than of hosts.
+"""
+try:
+    from hashlib import sha256
+except ImportError:
+    # Python 2.4.
+    sha256 = None
+
+from common import *
+
+
+# Name in `encodings()`.
+DEDUP = 'dedup'
+
+
+def digest(body):
+    """Return the SHA-256 digest (hex) of a body."""
+    if isinstance(body, unicode):
+        body = body.encode('utf-8')
+    return sha256(body).hexdigest()
+
+
+def _replace(section, bodies, min_size):
+    if isinstance(section, list):
+        return [_replace(item, bodies, min_size) for item in section]
+    elif not isinstance(section, dict):
+        return section
+
+    section = section.copy()
+    body = section.get('body')
+    if isinstance(body, basestring) and len(body) >= min_size:
+        body_digest = digest(body)
+        bodies[body_digest] = body
+        del section['body']
+        section['body_sha256'] = body_digest
+    if isinstance(section.get('included'), list):
+        section['included'] = _replace(section['included'], bodies, min_size)
+    return section
+
+
+def replace_bodies(section, min_size=0):
+    """
+    Return a copy of a config section with every body of at least
+    `min_size` bytes replaced by its digest (`body_sha256`), and the
+    replaced bodies as {digest: body}.
+    """
+    bodies = {}
+    return _replace(section, bodies, min_size), bodies
+
+
+def resolve_bodies(section, bodies):
+    """
+    Return a copy of a config section with every `body_sha256` replaced by
+    its body from `bodies` ({digest: body}). Raises `KeyError` for unknown
+    digests.
+    """
+    if isinstance(section, list):
+        return [resolve_bodies(item, bodies) for item in section]
+    elif not isinstance(section, dict):
+        return section
+
+    section = section.copy()
+    if 'body_sha256' in section:
+        section['body'] = bodies[section.pop('body_sha256')]
+    if isinstance(section.get('included'), list):
+        section['included'] = resolve_bodies(section['included'], bodies)
+    return section
+
+
+def batches(bodies, size):
+    """
+    Split {digest: body} into dictionaries of about `size` bytes of bodies
+    (a larger body gets a batch of its own).
+    """
+    batch = {}
+    batch_size = 0
+    for body_digest, body in bodies.iteritems():
+        if batch and batch_size + len(body) > size:
+            yield batch
+            batch = {}
+            batch_size = 0
+        batch[body_digest] = body
+        batch_size += len(body)
+
+    if batch:
+        yield batch
@@ -0,0 +1,138 @@
+import os
+
+try:
+    from hashlib import sha1
+except ImportError:
+    # Python 2.4.
+    from sha import new as sha1
+
+from common import *
+
+
+def _canonical(value):
+    """
+    Return a stable string representation of `value` (dictionary keys are
+    sorted) suitable for hashing.
+    """
+    if isinstance(value, dict):
+        keys = value.keys()
+        keys.sort()
+        return '{%s}' % ','.join(['%r:%s' % (k, _canonical(value[k]))
+                                  for k in keys])
+    elif isinstance(value, (list, tuple)):
+        return '[%s]' % ','.join([_canonical(v) for v in value])
+    return repr(value)
+
+
+def digest(value):
+    """Return the content hash of a payload section."""
+    return sha1(_canonical(value)).hexdigest()
+
+
+class DeltaState:
+    """
+    Keep a content hash for each payload section (and each Apache file) of
+    the last successful upload, and replace unchanged sections with their
+    hashes.
+    """
+    def __init__(self, filename=None):
+        if filename is None:
+            filename = config.DELTA_STATE_FILE
+        self.filename = path(filename)
+        self.hashes = {}
+        self.pending = {}
+
+    def load(self):
+        """Load section hashes from the state file (if one exists)."""
+        self.hashes = {}
+        try:
+            state_file = open(self.filename, 'r')
+            lines = state_file.readlines()
+            state_file.close()
+        except IOError:
+            return self.hashes
+
+        for line in lines:
+            ls = line.rstrip('\n').split('\t', 1)
+            if len(ls) == 2:
+                self.hashes[ls[1]] = ls[0]
+
+        return self.hashes
+
+    def save(self):
+        """Atomically write section hashes to the state file."""
+        tmp_fn = '%s.tmp' % self.filename
+        try:
+            state_file = open(tmp_fn, 'w')
+            for key, value in self.hashes.iteritems():
+                state_file.write('%s\t%s\n' % (value, key))
+            state_file.close()
+            os.rename(tmp_fn, self.filename)
+        except (IOError, OSError):
+            print "Notice: Cannot write delta state file '%s'" % self.filename
+
+    def _section(self, key, value, full):
+        value_hash = digest(value)
+        self.pending[key] = value_hash
+
+        if not full and self.hashes.get(key) == value_hash:
+            return {'unchanged': value_hash}
+        return value
+
+    def _apache(self, apache, full):
+        key = 'apache:%s' % apache['filename']
+        value = self._section(key, apache, full)
+
+        if 'unchanged' in value:
+            value['filename'] = apache['filename']
+        return value
+
+    def _iptables(self, ipt_dict, full):
+        tables = []
+        for table in ipt_dict['rules']['tables']:
+            chains = []
+            for chain in table['chains']:
+                key = 'iptables:%s:%s' % (table['name'], chain['name'])
+                self.pending[key] = chain['hash']
+
+                if not full and self.hashes.get(key) == chain['hash']:
+                    chain = {'name': chain['name'], 'unchanged': chain['hash']}
+                chains.append(chain)
+            tables.append({'name': table['name'], 'chains': chains})
+
+        return {'status': ipt_dict['status'], 'rules': {'tables': tables}}
+
+    def begin(self):
+        """Start building a payload (forgetting any hashes not committed)."""
+        self.pending = {}
+
+    def build_section(self, name, value, full=False):
+        """
+        Return section `name` of the payload, or `{'unchanged': <hash>}` if
+        it is unchanged since the last successful upload (see `build`).
+        """
+        if name == 'apache':
+            return [self._apache(a, full) for a in value]
+        elif name == 'iptables':
+            return self._iptables(value, full)
+        return self._section(name, value, full)
+
+    def build(self, sections, full=False):
+        """
+        Return a copy of the payload ({name: section}) with each section
+        that is unchanged since the last successful upload replaced by
+        `{'unchanged': <hash>}`. Apache files are compared one by one and
+        keep their `filename`; iptables chains are compared by their hashes
+        and keep their `name`. If `full`, every section is sent.
+        """
+        self.begin()
+        payload = {}
+        for name, value in sections.iteritems():
+            payload[name] = self.build_section(name, value, full)
+        return payload
+
+    def commit(self):
+        """Record the hashes of the sections just uploaded successfully."""
+        self.hashes = self.pending
+        self.pending = {}
+        self.save()
@@ -1,27 +1,163 @@
 from ConfigParser import RawConfigParser, ParsingError
+import array
+import binascii
 import cStringIO
+import fcntl
 import os
 import re
-import subprocess
+import socket
+import struct
 import string
 
-from apacheparser import *
+try:
+    from hashlib import sha1
+except ImportError:
+    # Python 2.4.
+    from sha import new as sha1
+
 from common import *
+import command
 
 # TODO: Use `logging`.
 
+# Interface ioctls (from `linux/sockios.h`).
+SIOCGIFCONF = 0x8912
+SIOCGIFNETMASK = 0x891b
+
+# TCP socket state in `/proc/net/tcp` (from `include/net/tcp_states.h`).
+TCP_LISTEN = '0A'
+
 
 class Interfaces:
     @classmethod
-    def get_interfaces(cls):
+    def _ioctl_addrs(cls):
+        """
+        Return a list of (label, IP address, netmask) tuples for every IPv4
+        address (including aliases and secondary addresses) using the
+        `SIOCGIFCONF` and `SIOCGIFNETMASK` ioctls.
+        """
+        # `struct ifreq` is 40 bytes on 64-bit platforms and 32 bytes on 32-bit.
+        ifreq_size = struct.calcsize('P') == 8 and 40 or 32
+        addrs = []
+
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            max_ifs = 128
+            while True:
+                buf = array.array('B', '\0' * (max_ifs * ifreq_size))
+                ifconf = struct.pack('iP', len(buf), buf.buffer_info()[0])
+                ifconf = fcntl.ioctl(sock.fileno(), SIOCGIFCONF, ifconf)
+                length = struct.unpack('iP', ifconf)[0]
+
+                # Retry with a bigger buffer if it was filled completely.
+                if length < len(buf):
+                    break
+                max_ifs *= 2
+
+            data = buf.tostring()
+            for offset in range(0, length, ifreq_size):
+                label = data[offset:offset + 16].split('\0', 1)[0]
+                ip = socket.inet_ntoa(data[offset + 20:offset + 24])
+
+                ifreq = struct.pack('256s', label)
+                ifreq = fcntl.ioctl(sock.fileno(), SIOCGIFNETMASK, ifreq)
+                mask = socket.inet_ntoa(ifreq[20:24])
+
+                addrs.append((label, ip, mask))
+        finally:
+            sock.close()
+
+        return addrs
+
+    @classmethod
+    def _inet6_addrs(cls, filename=None):
+        """
+        Parse `if_inet6` and return a dictionary of IPv6 addresses (with
+        prefix length) for each interface.
+        """
+        if filename is None:
+            filename = config.IF_INET6
+        inet6_dict = {}
+        try:
+            inet6_file = open(filename, 'r')
+            lines = inet6_file.readlines()
+            inet6_file.close()
+        except IOError:
+            return inet6_dict
+
+        for line in lines:
+            # <address> <ifindex> <prefix length> <scope> <flags> <name>
+            ls = line.split()
+            if len(ls) != 6:
+                continue
+
+            ip6 = socket.inet_ntop(socket.AF_INET6, binascii.unhexlify(ls[0]))
+            inet6_dict.setdefault(ls[5], []).append(
+                '%s/%d' % (ip6, int(ls[2], 16)))
+
+        return inet6_dict
+
+    @classmethod
+    def _get_mac(cls, interface, net_dir=None):
+        """Return MAC address of an interface (or alias) from sysfs."""
+        if net_dir is None:
+            net_dir = config.SYS_CLASS_NET
+        interface = interface.split(':')[0]
+        try:
+            mac_file = open(os.path.join(net_dir, interface, 'address'), 'r')
+            mac = mac_file.readline().strip().lower()
+            mac_file.close()
+        except IOError:
+            return ''
+
+        # Interfaces without a hardware address (e.g., loopback).
+        if not mac.replace('0', '').replace(':', ''):
+            return ''
+        return mac
+
+    @classmethod
+    def _get_native_interfaces(cls, net_dir=None):
         """
         Return dictionary of IP address, MAC address, and netmask for each
-        interface.
+        interface and alias from sysfs, procfs, and ioctls.
         """
+        if net_dir is None:
+            net_dir = config.SYS_CLASS_NET
         i_dict = {}
 
-        open_files = subprocess.Popen(IFCONFIG, shell=True,
-                                      stdout=subprocess.PIPE).communicate()[0]
+        for interface in os.listdir(net_dir):
+            i_dict[interface] = {'i_ip': '', 'i_mac': '', 'i_mask': ''}
+
+        for label, ip, mask in cls._ioctl_addrs():
+            i_dict.setdefault(label, {'i_ip': '', 'i_mac': '', 'i_mask': ''})
+
+            if i_dict[label]['i_ip']:
+                # Secondary address without a label of its own.
+                i_dict[label].setdefault('i_secondary', []).append(
+                    '%s/%s' % (ip, mask))
+            else:
+                i_dict[label]['i_ip'] = ip
+                i_dict[label]['i_mask'] = mask
+
+        for interface, ip6s in cls._inet6_addrs().iteritems():
+            if interface in i_dict:
+                i_dict[interface]['i_ip6'] = ip6s
+
+        for interface in i_dict:
+            i_dict[interface]['i_mac'] = cls._get_mac(interface)
+
+        return i_dict
+
+    @classmethod
+    def _get_ifconfig_interfaces(cls, open_files=None):
+        """
+        Parse `ifconfig` (or the given output) and return dictionary of IP
+        address, MAC address, and netmask for each interface.
+        """
+        i_dict = {}
+
+        if open_files is None:
+            open_files = command.run(config.IFCONFIG).output
         lines = open_files.split('\n')
         interface = ''
 
@@ -29,15 +165,18 @@ class Interfaces:
             if not line:
                 continue
 
-            ls = line.split(' ')
+            ls = line.split()
 
-            if ls[0].strip():
-                interface = ls[0].strip()
+            if not line[0].isspace():
+                # Newer net-tools print `eth0: flags=...`.
+                interface = ls[0].rstrip(':')
                 i_dict[interface] = {'i_ip': '', 'i_mac': '', 'i_mask': ''}
 
             # Get MAC address.
-            if 'HWaddr' in ls:
-                i_dict[interface]['i_mac'] = ls[ls.index('HWaddr') + 1].lower()
+            for keyword in ('HWaddr', 'ether'):
+                if keyword in ls:
+                    i_dict[interface]['i_mac'] = \
+                        ls[ls.index(keyword) + 1].lower()
 
             # Get IP address and netmask.
             if 'inet' in ls:
@@ -47,13 +186,27 @@ class Interfaces:
                 else:
                     i_dict[interface]['i_ip'] = inet
 
-                if ':' in ls[-1]:
+                if 'netmask' in ls:
+                    i_dict[interface]['i_mask'] = ls[ls.index('netmask') + 1]
+                elif ':' in ls[-1]:
                     i_dict[interface]['i_mask'] = ls[-1].split(':')[1]
                 else:
                     i_dict[interface]['i_mask'] = ls[-1]
 
         return i_dict
 
+    @classmethod
+    def get_interfaces(cls):
+        """
+        Return dictionary of IP address, MAC address, and netmask for each
+        interface. Falls back to parsing `ifconfig` where sysfs and the
+        interface ioctls are unavailable.
+        """
+        try:
+            return cls._get_native_interfaces()
+        except (IOError, OSError, socket.error):
+            return cls._get_ifconfig_interfaces()
+
 
 class System:
     @classmethod
@@ -69,8 +222,7 @@ class System:
     @classmethod
     def _get_hostname(self):
         """Parse `hostname` and return local hostname."""
-        full_hn = subprocess.Popen(HOSTNAME, shell=True,
-                                   stdout=subprocess.PIPE).communicate()[0]
+        full_hn = command.run(config.HOSTNAME).output
 
         p = re.compile(r'([^\.]+)')
         m = p.match(full_hn)
@@ -82,15 +234,16 @@ class System:
         """
         Call `uname -r` and return kernel release version number.
         """
-        kernel_rel = subprocess.Popen('%s -r' % UNAME, shell=True,
-                                      stdout=subprocess.PIPE).communicate()[0]
+        kernel_rel = command.run(config.UNAME, '-r').output
         return kernel_rel.strip()
 
     @classmethod
-    def _get_redhat_version(self, filename=RH_RELEASE):
+    def _get_redhat_version(self, filename=None):
         """
         Parse `redhat-release` file and return release name and version number.
         """
+        if filename is None:
+            filename = config.RH_RELEASE
         rh_version = ''
         try:
             rh_file = open(filename, 'r')
@@ -109,10 +262,12 @@ class System:
         return rh_version.strip()
 
     @classmethod
-    def _ip_fwd_status(self, filename=IP_FORWARD):
+    def _ip_fwd_status(self, filename=None):
         """
         Parse `ip_forward` file and return a boolean of IP forwarding status.
         """
+        if filename is None:
+            filename = config.IP_FORWARD
         ip_fwd = 0
         try:
             ip_file = open(filename, 'r')
@@ -135,8 +290,7 @@ class System:
         """
         found_nfs = 0
 
-        mount_info = subprocess.Popen('%s -l' % MOUNT, shell=True,
-                                      stdout=subprocess.PIPE).communicate()[0]
+        mount_info = command.run(config.MOUNT, '-l').output
         mount_info = mount_info.strip('\n')
         lines = mount_info.split('\n')
 
@@ -166,15 +320,117 @@ class System:
 
 class Services:
     @classmethod
-    def get_services(cls):
+    def _listening_inodes(cls, proc_dir=None):
         """
-        Parse `lsof -ni -P` and return a dictionary of all listening processes
-        and ports.
+        Parse the `/proc/net` socket tables and return a dictionary of
+        listening socket inodes and their local ports. TCP sockets in the
+        LISTEN state and unconnected (bound) UDP sockets are included.
+        """
+        if proc_dir is None:
+            proc_dir = config.PROC
+        inodes = {}
+
+        for table in ('tcp', 'tcp6', 'udp', 'udp6'):
+            try:
+                table_file = open(os.path.join(proc_dir, 'net', table), 'r')
+                lines = table_file.readlines()
+                table_file.close()
+            except IOError:
+                continue
+
+            # sl local_address rem_address st ... uid timeout inode ...
+            for line in lines[1:]:
+                ls = line.split()
+                if len(ls) < 10:
+                    continue
+
+                local_port = int(ls[1].split(':')[1], 16)
+                remote_port = int(ls[2].split(':')[1], 16)
+                state = ls[3]
+
+                if table.startswith('tcp') and state != TCP_LISTEN:
+                    continue
+                if table.startswith('udp') and remote_port != 0:
+                    continue
+
+                if ls[9] != '0':
+                    inodes[ls[9]] = local_port
+
+        return inodes
+
+    @classmethod
+    def _get_proc_services(cls, proc_dir=None):
+        """
+        Scan `/proc/net` socket tables and map the listening sockets to
+        processes in a single pass over `/proc/*/fd`. Return a dictionary of
+        all listening processes and ports.
+        """
+        if proc_dir is None:
+            proc_dir = config.PROC
+        ports_dict = {}
+
+        inodes = cls._listening_inodes(proc_dir)
+        if not inodes:
+            return ports_dict
+
+        for pid in os.listdir(proc_dir):
+            if not pid.isdigit():
+                continue
+
+            fd_dir = os.path.join(proc_dir, pid, 'fd')
+            try:
+                fds = os.listdir(fd_dir)
+            except OSError:
+                # Process exited or not permitted.
+                continue
+
+            ports = []
+            for fd in fds:
+                try:
+                    link = os.readlink(os.path.join(fd_dir, fd))
+                except OSError:
+                    continue
+
+                # Socket links look like `socket:[<inode>]`.
+                if link.startswith('socket:[') and link[8:-1] in inodes:
+                    ports.append(inodes[link[8:-1]])
+
+            if not ports:
+                continue
+
+            # `/proc/<pid>/comm` is missing before Linux 2.6.33; `stat` reads
+            # `<pid> (<comm>) ...`, and the name may itself contain ')'.
+            try:
+                stat_file = open(os.path.join(proc_dir, pid, 'stat'), 'r')
+                try:
+                    stat = stat_file.readline()
+                finally:
+                    stat_file.close()
+            except IOError:
+                continue
+            proc_name = stat[stat.find('(') + 1:stat.rfind(')')]
+
+            ports_dict.setdefault(proc_name, [])
+            for port in ports:
+                if port not in ports_dict[proc_name]:
+                    ports_dict[proc_name].append(port)
+
+        for k, v in ports_dict.iteritems():
+            v.sort()
+            ports_dict[k] = ', '.join([str(port) for port in v])
+
+        return ports_dict
+
+    @classmethod
+    def _get_lsof_services(cls, open_files=None):
+        """
+        Parse `lsof -ni -P` (or the given output) and return a dictionary of
+        all listening processes and ports.
         """
         ports_dict = {}
 
-        open_files = subprocess.Popen('%s -ni -P' % LSOF, shell=True,
-                                      stdout=subprocess.PIPE).communicate()[0]
+        if open_files is None:
+            open_files = command.run(config.LSOF, '-ni', '-P').output
         lines = open_files.split('\n')
 
         for line in lines:
@@ -201,75 +457,267 @@ class Services:
 
         return ports_dict
 
+    @classmethod
+    def get_services(cls):
+        """
+        Return a dictionary of all listening processes and ports, from the
+        `/proc/net` socket tables or (if configured) from `lsof`.
+        """
+        if config.SERVICES_BACKEND == 'lsof':
+            return cls._get_lsof_services()
+        return cls._get_proc_services()
+
 
 class RPMs:
     @classmethod
-    def get_rpms(cls, filename=RPM_PKGS):
-        """Get all RPMs installed."""
-        rpms_dict = {'list': ''}
+    def _parse_rpm_filename(cls, rpm_fn):
+        """
+        Split an `rpmpkgs` entry (`<name>-<version>-<release>.<arch>.rpm`)
+        into a package record. The epoch is not recorded in `rpmpkgs`.
+        """
+        if rpm_fn.endswith('.rpm'):
+            rpm_fn = rpm_fn[:-4]
 
-        try:
-            rpmpkgs_file = open(filename, 'r')
-            lines = rpmpkgs_file.readlines()
-            rpmpkgs_file.close()
+        nvr, arch = rpm_fn, ''
+        if '.' in rpm_fn:
+            nvr, arch = rpm_fn.rsplit('.', 1)
+
+        ls = nvr.rsplit('-', 2)
+        if len(ls) != 3:
+            return None
 
-            lines_str = ''.join(lines)
-            lines_str = lines_str.strip('\n')
+        return {'name': ls[0], 'epoch': '', 'version': ls[1],
+                'release': ls[2], 'arch': arch}
 
-            rpms_dict = {'list': lines_str}
+    @classmethod
+    def _read_rpmdb(cls):
+        """Return package records read from the RPM database."""
+        import rpm
+
+        packages = []
+        ts = rpm.TransactionSet()
+        for hdr in ts.dbMatch():
+            record = {}
+            for tag in ('name', 'epoch', 'version', 'release', 'arch'):
+                value = hdr[tag]
+                record[tag] = value is not None and str(value) or ''
+            packages.append(record)
+
+        return packages
+
+    @classmethod
+    def _read_rpmpkgs(cls, filename=None):
+        """Return package records parsed from the `rpmpkgs` file."""
+        if filename is None:
+            filename = config.RPM_PKGS
+        packages = []
+
+        try:
+            rpmpkgs_file = open(filename, 'r')
+            try:
+                for line in rpmpkgs_file:
+                    record = cls._parse_rpm_filename(line.strip())
+                    if record:
+                        packages.append(record)
+            finally:
+                rpmpkgs_file.close()
         except IOError:
             # TODO: Logging Error.
             #raise Exception("Notice: Cannot open rpmpkgs file '%s'." % filename)
             print "Notice: Cannot open rpmpkgs file '%s'" % filename
 
-        return rpms_dict
+        return packages
+
+    @classmethod
+    def get_backend(cls):
+        """
+        Return where packages are read from: 'rpmdb' if the `rpm` module is
+        available, otherwise 'rpmpkgs'.
+        """
+        try:
+            import rpm
+        except ImportError:
+            return 'rpmpkgs'
+        return 'rpmdb'
+
+    @classmethod
+    def get_packages(cls, backend=None):
+        """
+        Return a sorted list of name/epoch/version/release/arch records of
+        all RPMs installed, from the RPM database or the `rpmpkgs` file
+        (see `get_backend`). An unreadable database (e.g., locked during a
+        yum run) raises `rpm.error`: `rpmpkgs` lacks epochs and may be
+        missing, so falling back to it would report spurious changes.
+        """
+        if backend is None:
+            backend = cls.get_backend()
+
+        if backend == 'rpmdb':
+            packages = cls._read_rpmdb()
+        else:
+            packages = cls._read_rpmpkgs()
+
+        packages.sort(key=RPMSnapshot.key)
+        return packages
+
+    @classmethod
+    def get_rpms(cls, snapshot=None):
+        """
+        Get all RPMs installed. If a snapshot of the last upload is given,
+        return only the packages added, removed or upgraded since.
+        """
+        backend = cls.get_backend()
+        packages = cls.get_packages(backend)
+
+        if snapshot is None:
+            return {'full': True, 'backend': backend, 'packages': packages}
+        return snapshot.diff(packages, backend=backend)
+
+
+class RPMSnapshot:
+    """
+    Local snapshot of the packages sent in the last successful upload, used
+    to send only package changes. The backend the packages were read from
+    is recorded too: records from `rpmpkgs` and the RPM database differ
+    (epochs), so they are never diffed against each other.
+    """
+    fields = ('name', 'epoch', 'version', 'release', 'arch')
+
+    def __init__(self, filename=None):
+        if filename is None:
+            filename = config.RPM_SNAPSHOT_FILE
+        self.filename = path(filename)
+        self.packages = None
+        self.backend = None
+        self.pending = None
+        self.pending_backend = None
+
+    @classmethod
+    def key(cls, record):
+        return tuple([record[field] for field in cls.fields])
+
+    def load(self):
+        """Load the snapshot (if one exists)."""
+        self.packages = None
+        self.backend = None
+        try:
+            snapshot_file = open(self.filename, 'r')
+            lines = snapshot_file.readlines()
+            snapshot_file.close()
+        except IOError:
+            return
+
+        self.packages = {}
+        for line in lines:
+            ls = line.rstrip('\n').split('\t')
+            if len(ls) == 2 and ls[0] == '#backend':
+                self.backend = ls[1]
+            elif len(ls) == len(self.fields):
+                self.packages[tuple(ls)] = dict(zip(self.fields, ls))
+
+    def diff(self, packages, full=False, backend=None):
+        """
+        Return the full package list if there is no snapshot (or `full`, or
+        the packages were read from another `backend`), otherwise the
+        packages added, removed and upgraded (`from` and `to` records)
+        since the snapshot.
+        """
+        current = dict([(self.key(record), record) for record in packages])
+        self.pending = current
+        self.pending_backend = backend
+
+        if full or self.packages is None or backend != self.backend:
+            return {'full': True, 'packages': packages}
+
+        added = [current[k] for k in current if k not in self.packages]
+        removed = [self.packages[k] for k in self.packages if k not in current]
+
+        # A package (name and arch) both removed and added was upgraded.
+        removed_by_name = {}
+        for record in removed:
+            removed_by_name.setdefault((record['name'], record['arch']),
+                                       []).append(record)
+
+        upgraded = []
+        new_added = []
+        for record in added:
+            old = removed_by_name.get((record['name'], record['arch']))
+            if old:
+                upgraded.append({'from': old.pop(0), 'to': record})
+            else:
+                new_added.append(record)
+
+        removed = []
+        for records in removed_by_name.values():
+            removed += records
+
+        for records in (new_added, removed):
+            records.sort(key=self.key)
+        upgraded.sort(key=lambda u: self.key(u['to']))
+
+        return {'full': False, 'count': len(packages), 'added': new_added,
+                'removed': removed, 'upgraded': upgraded}
+
+    def build(self, rpms, full=False):
+        """Return the `rpms` section (a full package list) to send."""
+        return self.diff(rpms['packages'], full, rpms.get('backend'))
+
+    def commit(self):
+        """Record the packages just uploaded successfully as the snapshot."""
+        if self.pending is None:
+            return
+
+        tmp_fn = '%s.tmp' % self.filename
+        try:
+            snapshot_file = open(tmp_fn, 'w')
+            if self.pending_backend is not None:
+                snapshot_file.write('#backend\t%s\n' % self.pending_backend)
+            for k in self.pending:
+                snapshot_file.write('%s\n' % '\t'.join(k))
+            snapshot_file.close()
+            os.rename(tmp_fn, self.filename)
+        except (IOError, OSError):
+            print "Notice: Cannot write RPM snapshot file '%s'" % self.filename
+            return
+
+        self.packages = self.pending
+        self.backend = self.pending_backend
 
 
 class SSHConfig:
     @classmethod
-    def parse(cls, filename=SSH_CONFIG_FILE):
+    def parse(cls, filename=None):
         """
         Parse SSH configuration file and a return a dictionary of
         body, parameters/values, and filename.
         """
-        body = ''
+        if filename is None:
+            filename = config.SSH_CONFIG_FILE
+        body = []
         items = {}
         filename = path(filename)
 
         try:
             file_obj = open(filename, 'r')
-            lines = file_obj.readlines()
-            file_obj.close()
+            try:
+                for line in clean_lines(file_obj, '#'):
+                    if line[0] != '#':
+                        ls = re.split('\s*', line)
+
+                        if ls[0] in items:
+                            items[ls[0]] += [' %s' % ' '.join(ls[1:])]
+                        else:
+                            items[ls[0]] = [' '.join(ls[1:])]
+
+                    body.append('%s\n' % line)
+            finally:
+                file_obj.close()
 
         except IOError:
             #raise Exception("Notice: Cannot open SSH config file '%s'." % filename)
             print "Notice: Cannot open SSH config file '%s'" % filename
-            lines = ''
 
-        if lines:
-            body = ''
-            for index, line in enumerate(lines):
-                line = line.strip()
-
-                if not line or (not PARSE_CONF_COMMENTS and line[0] == '#'):
-                    continue
-
-                # Concatenate multiline instructions delimited by backslash-newlines.
-                if line and line[-1] == '\\':
-                    while line[-1] == '\\':
-                        line = ' '.join([line[:-1].strip(),
-                                         lines[index + 1].strip()])
-                        del lines[index + 1]
-
-                if line[0] != '#':
-                    ls = re.split('\s*', line)
-    
-                    if ls[0] in items:
-                        items[ls[0]] += [' %s' % ' '.join(ls[1:])]
-                    else:
-                        items[ls[0]] = [' '.join(ls[1:])]
-
-                body += '%s\n' % line
+        body = ''.join(body)
 
         ssh_dict = {'body': body, 'items': items, 'filename': filename}
 
@@ -284,8 +732,7 @@ class IPTables:
         """
         ipt_status = 0
 
-        status_info = subprocess.Popen('%s status' % IPTABLES, shell=True,
-                                       stdout=subprocess.PIPE).communicate()[0]
+        status_info = command.run(config.IPTABLES, 'status').output
         status_info = status_info.strip('\n')
 
         if status_info != 'Firewall is stopped.':
@@ -294,50 +741,107 @@ class IPTables:
         return ipt_status
 
     @classmethod
-    def _parse(self):
+    def _split_rule(cls, line):
         """
-        Parse IP tables and a return a dictionary of policies for each table.
+        Split an `-A <chain> <match> -j <target> <target options>` line into
+        the chain name and a rule dictionary.
         """
-        ipt_dict = {}
-
-        lines = subprocess.Popen(IPTABLES_SAVE, shell=True,
-                                 stdout=subprocess.PIPE).communicate()[0]
-        lines = lines.split('\n')
+        # Rules saved with counters (`iptables-save -c`) start with them.
+        if line[0] == '[':
+            line = line.split(None, 1)[1]
+
+        ls = line.split(None, 2)
+        chain_name = ls[1]
+        spec = len(ls) > 2 and ls[2] or ''
+
+        match, target, target_args = spec, '', ''
+        for jump in ('-j ', '-g '):
+            if spec.startswith(jump):
+                index = 0
+            else:
+                index = spec.find(' %s' % jump)
+                if index < 0:
+                    continue
+                index += 1
+            match = spec[:index].strip()
+            target_spec = spec[index + 3:].split(None, 1)
+            target = target_spec and target_spec[0] or ''
+            target_args = len(target_spec) > 1 and target_spec[1] or ''
+            break
 
-        table_name = ''
-        body = ''
+        return chain_name, {'match': match, 'target': target,
+                            'target_args': target_args}
 
-        for index, line in enumerate(lines):
-            line = line.strip()
+    @classmethod
+    def iter_tables(cls, lines):
+        """
+        Parse `iptables-save` output in a single streaming pass and generate
+        one dictionary per table (on its `COMMIT`): table name and chains,
+        each with its name, policy, rules (match, target, target options)
+        and a stable hash of its policy and rules. Chain and rule lines
+        outside a table (before its `*table` header) are skipped.
+        """
+        table = None
+        chains = {}
+        hashes = {}
 
-            if not line or (not PARSE_CONF_COMMENTS and line[0] == '#') or \
-              (PARSE_CONF_COMMENTS and line.startswith('# Generated by') or \
-               line.startswith('# Completed on')):
+        for line in clean_lines(lines, '#'):
+            if line[0] == '#':
                 continue
 
-            # Concatenate multiline instructions delimited by backslash-newlines.
-            if line and line[-1] == '\\':
-                while line[-1] == '\\':
-                    line = ' '.join([line[:-1].strip(),
-                                     lines[index + 1].strip()])
-                    del lines[index + 1]
+            elif line[0] == '*':
+                table = {'name': line[1:], 'chains': []}
+                chains = {}
+                hashes = {}
 
-            if line[0] == ':':
+            elif table is None:
+                # Chain, rule and `COMMIT` lines outside a table.
+                continue
+
+            elif line[0] == ':':
                 # Chain specification.
                 # :<chain-name> <chain-policy> [<packet-counter>:<byte-counter>]
+                ls = line[1:].split()
+                chain = {'name': ls[0], 'policy': len(ls) > 1 and ls[1] or '-',
+                         'rules': []}
+                table['chains'].append(chain)
+                chains[chain['name']] = chain
+                hashes[chain['name']] = sha1('%s\n' % chain['policy'])
+
+            elif line.startswith('-A ') or line[0] == '[':
+                chain_name, rule = cls._split_rule(line)
+                if chain_name not in chains:
+                    continue
+                chains[chain_name]['rules'].append(rule)
+                hashes[chain_name].update('%(match)s\t%(target)s\t%(target_args)s\n'
+                                          % rule)
 
-                # Strip packet-counter and byte-counter.
-                ls = line.split()
-                if len(ls) > 2 and ls[0].strip():
-                    chain_name = ls[0].strip()[1:]
-                    chain_policy = ls[1].strip()
-                    line = ':%s %s' % (chain_name, chain_policy)
+            elif line == 'COMMIT':
+                for chain in table['chains']:
+                    chain['hash'] = hashes[chain['name']].hexdigest()
+                yield table
+                table = None
 
-            body += '%s\n' % line
+    @classmethod
+    def _parse(cls, lines=None):
+        """
+        Parse IP tables and a return a dictionary of tables, each with its
+        chains (policy, rules and hash). `lines` defaults to the output of
+        `iptables-save`.
+        """
+        output = None
+        if lines is None:
+            # Parsed as it is read, so the output is never held whole.
+            output = command.OutputLines(config.IPTABLES_SAVE)
+            lines = output
 
-        ipt_dict['body'] = body
+        try:
+            tables = list(cls.iter_tables(lines))
+        finally:
+            if output is not None:
+                output.close()
 
-        return ipt_dict
+        return {'tables': tables}
 
     @classmethod
     def get_ipt_dict(cls):
@@ -350,172 +854,233 @@ class IPTables:
 class ApacheConfigList:
     def __init__(self):
         self.apache_configs = []
+        self.visited = {}
 
-    def recurse_apache_includes(self, fn, includes_list):
-        for i_fn in includes_list:
-            i_ac = ApacheConfig()
-            i_ac.parse(i_fn)
+    def _file_key(self, fn):
+        """
+        Return a key identifying the real file behind `fn` (device and
+        inode), so each file is parsed once however it is reached.
+        """
+        try:
+            st = os.stat(fn)
+            return (st.st_dev, st.st_ino)
+        except OSError:
+            return os.path.realpath(fn)
 
-            i_apache = {'body': i_ac.get_body(),
-                        'filename': i_fn,
-                        'directives': i_ac.get_directives(),
-                        'domains': i_ac.get_domains(),
-                        'included': i_ac.get_includes()}
+    def _parse_config(self, fn):
+        # Imported here so hosts without Apache never load the parser.
+        from apacheparser import ApacheConfig
 
-            # Remove circular includes.
-            try:
-                del i_apache['included'][i_apache['included'].index(fn)]
-            except ValueError:
-                pass
+        ac = ApacheConfig()
+        ac.parse(fn)
 
-            self.apache_configs.append(i_apache)
+        return {'body': ac.get_body(),
+                'filename': fn,
+                'directives': ac.get_directives(),
+                'domains': ac.get_domains(),
+                'included': ac.get_includes()}
 
-            self.recurse_apache_includes(i_fn, i_apache['included'])
+    def recurse(self, conf_file=None):
+        """
+        Walk the include graph depth-first from `conf_file`, parsing every
+        file once. Include cycles (e.g., A -> B -> A) and files included
+        through several paths are skipped once visited. Each parsed file's
+        `included` list holds its edges of the graph.
+        """
+        if conf_file is None:
+            conf_file = config.APACHE_CONF
+        stack = [conf_file]
 
-    def recurse(self):
-        ac = ApacheConfig()
-        ac.parse(APACHE_CONF)
+        while stack:
+            fn = stack.pop()
 
-        apache = {'body': ac.get_body(),
-                  'filename': APACHE_CONF,
-                  'directives': ac.get_directives(),
-                  'domains': ac.get_domains(),
-                  'included': ac.get_includes()}
+            key = self._file_key(fn)
+            if key in self.visited:
+                continue
+            self.visited[key] = fn
 
-        # Remove circular includes.
-        try:
-            del apache['included'][apache['included'].index(APACHE_CONF)]
-        except ValueError:
-            pass
+            apache = self._parse_config(fn)
+            self.apache_configs.append(apache)
 
-        self.apache_configs.append(apache)
+            # Reversed, so includes are visited in the order they appear.
+            included = apache['included'][:]
+            included.reverse()
+            stack.extend(included)
 
-        self.recurse_apache_includes(APACHE_CONF, apache['included'])
+    @classmethod
+    def get_watch_paths(cls, apache_configs):
+        """
+        Return the (files, directories) to watch for changes to the configs
+        in `apache_configs`: every parsed file plus the directories holding
+        included files (so new `conf.d` files are noticed).
+        """
+        files = [apache['filename'] for apache in apache_configs]
+        dirs = {}
+        for apache in apache_configs:
+            for i_fn in apache['included']:
+                dirs[os.path.dirname(i_fn)] = True
+        return files or [config.APACHE_CONF], dirs.keys()
 
     def get_apache_configs(self):
-        if os.path.exists(APACHE_CONF):
+        if os.path.exists(config.APACHE_CONF):
             self.recurse()
         return self.apache_configs
 
 
-class PHPConfig:
-    def get_items(self):
-        parameters = {}
-        php_config = RawConfigParser()
+class INIConfig:
+    """
+    Collector for an INI-style configuration file (e.g., `php.ini` or
+    `my.cnf`) plus the files it pulls in: `!include` and `!includedir`
+    directives and any configured scan directories (e.g., `php.d`). Every
+    file is read once per change; parsed files are cached by path, mtime,
+    size and inode.
+    """
+    # Parsed files: {path: ((mtime, size, inode), result)}.
+    cache = {}
 
-        sections = []
+    # File extensions read from `!includedir` and scan directories.
+    extensions = ('.cnf', '.ini')
 
-        try:
-            contents = file(path(MY_CNF))
-            lines = contents.readlines()
+    def __init__(self, filename, scan_dirs=()):
+        self.filename = filename
+        self.scan_dirs = list(scan_dirs)
+        self.include_dirs = []
 
-            # Workaround for `allow_no_value` (which is available in only Python 2.7+).
-            body = ''
-            for line in lines:
-                stripped_line = line.strip()
-                if not stripped_line or stripped_line[0] in ('#', ';'):
-                    pass
-
-                elif line[0] != '[' and line[-1] != ']' and \
-                   '=' not in line:
-                    line = '%s=\n' % line.rstrip('\n')
-
-                body += line
-
-            php_config.readfp(cStringIO.StringIO(body))
-
-            sections = php_config.sections()
-        except IOError:
-            #sys.exit("Notice: Cannot open PHP configuration file '%s'" % MY_CNF)
-            print "Notice: Cannot open PHP configuration file '%s'" % MY_CNF
-        except ParsingError, error:
-            print "Notice: Cannot parse PHP configuration file '%s'\n%s" % (PHP_INI, error)
-
-        for section in sections:
-            items = php_config.items(section)
-
-            for item in items:
-                if item[0] in parameters:
-                    parameters[item[0]] += [item[1]]
-                else:
-                    parameters[item[0]] = [item[1]]
+    def _dir_files(self, dn):
+        try:
+            basenames = os.listdir(dn)
+        except OSError:
+            return []
+        basenames.sort()
+        return [os.path.join(dn, basename) for basename in basenames
+                if os.path.splitext(basename)[1] in self.extensions]
+
+    def _read(self, filename):
+        """
+        Read and parse a file in one pass. Return a dictionary of body,
+        items, filename, and the `!include`/`!includedir` targets.
+        """
+        st = os.stat(filename)
+        signature = (st.st_mtime, st.st_size, st.st_ino)
 
-        return parameters
+        cached = self.cache.get(filename)
+        if cached and cached[0] == signature:
+            return cached[1]
 
-    def parse(self):
+        file_obj = open(filename, 'r')
         try:
-            file_obj = open(path(MY_CNF), 'r')
             lines = file_obj.readlines()
+        finally:
             file_obj.close()
 
-            body = clean_body(lines, '#')
-            items = self.get_items()
-            my_dict = {'body': body, 'items': items, 'filename': MY_CNF}
-        except IOError:
-            #raise Exception("Notice: Cannot open PHP configuration file '%s'" % MY_CNF)'
-            print "Notice: Cannot open PHP configuration file '%s'" % MY_CNF
-            my_dict = {'body': '', 'items': [], 'filename': ''}
-
-        return my_dict
-
+        includes = []
+        include_dirs = []
 
-class MySQLConfig:
-    def get_items(self):
-        parameters = {}
-        mysql_config = RawConfigParser()
-
-        sections = []
+        # Lines before the first section header go to a `global` section.
+        ini_lines = ['[global]\n']
+        for line in lines:
+            stripped_line = line.strip()
 
-        try:
-            contents = file(path(MY_CNF))
-            lines = contents.readlines()
+            if stripped_line.startswith('!include '):
+                includes.append(stripped_line.split(None, 1)[1])
+                continue
+            elif stripped_line.startswith('!includedir '):
+                include_dirs.append(stripped_line.split(None, 1)[1])
+                continue
 
             # Workaround for `allow_no_value` (which is available in only Python 2.7+).
-            body = ''
-            for line in lines:
-                stripped_line = line.strip()
-                if not stripped_line or stripped_line[0] in ('#', ';'):
-                    pass
-
-                elif line[0] != '[' and line[-1] != ']' and \
-                   '=' not in line:
-                    line = '%s=\n' % line.rstrip('\n')
-
-                body += line
+            if stripped_line and stripped_line[0] not in ('#', ';', '[') and \
+               '=' not in line:
+                line = '%s=\n' % line.rstrip('\n')
 
-            mysql_config.readfp(cStringIO.StringIO(body))
+            ini_lines.append(line)
 
-            sections = mysql_config.sections()
-        except IOError:
-            #sys.exit("Notice: Cannot open MySQL configuration file '%s'" % MY_CNF)
-            print "Notice: Cannot open MySQL configuration file '%s'" % MY_CNF
+        items = {}
+        ini_config = RawConfigParser()
+        try:
+            ini_config.readfp(cStringIO.StringIO(''.join(ini_lines)))
         except ParsingError, error:
-            print "Notice: Cannot parse PHP configuration file '%s'\n%s" % (PHP_INI, error)
-
-        for section in sections:
-            items = mysql_config.items(section)
-
-            for item in items:
-                if item[0] in parameters:
-                    parameters[item[0]] += [item[1]]
-                else:
-                    parameters[item[0]] = [item[1]]
-
-        return parameters
+            print "Notice: Cannot parse configuration file '%s'\n%s" % (
+                filename, error)
+        else:
+            for section in ini_config.sections():
+                for item in ini_config.items(section):
+                    items.setdefault(item[0], []).append(item[1])
+
+        result = {'body': clean_body(lines, '#;'), 'items': items,
+                  'filename': filename, 'includes': includes,
+                  'include_dirs': include_dirs}
+        self.cache[filename] = (signature, result)
+        return result
 
     def parse(self):
-        try:
-            file_obj = open(path(MY_CNF), 'r')
-            lines = file_obj.readlines()
-            file_obj.close()
-
-            body = clean_body(lines, '#')
-            items = self.get_items()
-            my_dict = {'body': body, 'items': items, 'filename': MY_CNF}
-        except IOError:
-            #raise Exception("Notice: Cannot open MySQL configuration file '%s'" % MY_CNF)'
-            print "Notice: Cannot open MySQL configuration file '%s'" % MY_CNF
-            my_dict = {'body': '', 'items': [], 'filename': ''}
+        """
+        Return a dictionary of body, items (merged from every file read,
+        in order), filename, and the body of each included file.
+        """
+        filename = path(self.filename)
 
-        return my_dict
+        try:
+            main = self._read(filename)
+        except (IOError, OSError):
+            #raise Exception("Notice: Cannot open configuration file '%s'" % filename)
+            print "Notice: Cannot open configuration file '%s'" % filename
+            return {'body': '', 'items': [], 'filename': ''}
 
+        items = {}
+        included = []
+        visited = {filename: True}
+        self.include_dirs = []
+
+        queue = [main]
+        for dn in self.scan_dirs:
+            queue.append(dn)
+
+        while queue:
+            entry = queue.pop(0)
+
+            if isinstance(entry, dict):
+                results = [entry]
+            else:
+                # Directory to scan.
+                self.include_dirs.append(entry)
+                results = []
+                for fn in self._dir_files(entry):
+                    if fn in visited:
+                        continue
+                    visited[fn] = True
+                    try:
+                        results.append(self._read(fn))
+                    except (IOError, OSError):
+                        print "Notice: Cannot open configuration file '%s'" % fn
+
+            for result in results:
+                for k, v in result['items'].iteritems():
+                    items.setdefault(k, []).extend(v)
+
+                if result is not main:
+                    included.append({'body': result['body'],
+                                     'filename': result['filename']})
+
+                # Follow `!include` and `!includedir` (in place).
+                follow = []
+                for fn in result['includes']:
+                    if fn in visited:
+                        continue
+                    visited[fn] = True
+                    try:
+                        follow.append(self._read(fn))
+                    except (IOError, OSError):
+                        print "Notice: Cannot open configuration file '%s'" % fn
+                follow += result['include_dirs']
+                queue[0:0] = follow
+
+        return {'body': main['body'], 'items': items, 'filename': filename,
+                'included': included}
+
+    def get_watch_paths(self, result):
+        """Return the (files, directories) read by the last `parse`."""
+        files = [self.filename]
+        for i in result.get('included', []):
+            files.append(i['filename'])
+        return files, self.include_dirs
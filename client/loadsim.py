@@ -0,0 +1,340 @@
+#!/usr/bin/env python
+"""
+Fleet load simulator: many virtual clients uploading inventories at once.
+
+    python loadsim.py [--clients=1000] [--processes=4] [--rounds=1]
+                      [--ramp=0] [--scale=1000] [--inventory=FILE]
+                      [--host=http://localhost:8668] [--no-gzip]
+                      [--encoding=auto|xmlrpc] [--no-dedup]
+
+Every virtual client keeps its own connection and sends `authenticate` and
+`machine` in one multicall, like `client.py` (in the compact encoding if
+the server offers it, unless `--encoding=xmlrpc`), first uploading the
+configuration bodies the server lacks if it offers body deduplication
+(unless `--no-dedup`). Inventories are synthetic
+(built by the real parsers from the `benchmark.py` fixtures, `--scale`
+lines/packages/rules per section) or replayed from a file captured with
+`mockserver.py --capture`; each client's copy carries its own hostname.
+
+Without `--host`, a `MockInventoryServer` is started in a separate process
+and its unmarshalling/marshalling CPU times and request sizes are reported
+along with the clients' throughput, latency percentiles and bytes on the
+wire.
+"""
+from optparse import OptionParser
+import marshal
+import os
+import random
+import signal
+import socket
+import sys
+import threading
+import time
+import xmlrpclib
+
+from benchmark import synthetic_inventory
+from common import *
+from compact import CompactServerProxy
+from dedup import DEDUP, batches, replace_bodies
+from metrics import percentile
+from mockserver import MockInventoryServer
+from transport import CompressedTransport
+
+
+# Sections whose bodies are sent by digest (the built-in `dedup` collectors
+# and the default `[ini]` entries).
+DEDUP_SECTIONS = ('apache', 'sshd', 'php', 'mysql')
+
+
+## Inventories.
+
+def load_inventory(fn):
+    """Return the inventory from a `machine` request captured to `fn`."""
+    capture_file = open(fn, 'r')
+    try:
+        params, method = xmlrpclib.loads(capture_file.read())
+    finally:
+        capture_file.close()
+    return params[0]
+
+
+def client_inventory(inventory, index):
+    """Return a copy of `inventory` with a hostname of its own."""
+    inventory = inventory.copy()
+    system = dict(inventory.get('system') or {})
+    system['hostname'] = 'vc%06d.example.com' % index
+    inventory['system'] = system
+    return inventory
+
+
+## Virtual clients.
+
+class VirtualClient(threading.Thread):
+    """
+    Thread uploading an inventory `rounds` times over its own connection,
+    recording the latency of each upload.
+    """
+    def __init__(self, uri, inventory, rounds, delay, gzip, encoding, dedup):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.transport = CompressedTransport(compress=gzip)
+        self.proxy = CompactServerProxy(uri, self.transport, encoding)
+        self.inventory = inventory
+        self.rounds = rounds
+        self.delay = delay
+        self.dedup = dedup
+        self.latencies = []
+        self.errors = 0
+
+    def send_bodies(self):
+        """
+        Upload the bodies the server lacks; return the inventory with its
+        bodies sent by digest.
+        """
+        inventory = self.inventory.copy()
+        bodies = {}
+        for name in DEDUP_SECTIONS:
+            if name in inventory:
+                inventory[name], found = replace_bodies(
+                    inventory[name], config.DEDUP_MIN_SIZE)
+                bodies.update(found)
+
+        missing = self.proxy.bodies_missing(config.AUTH_TOKEN, bodies.keys())
+        for batch in batches(dict([(d, bodies[d]) for d in missing]),
+                             config.CHUNK_SIZE):
+            self.proxy.bodies_put(config.AUTH_TOKEN, batch)
+        return inventory
+
+    def run(self):
+        time.sleep(self.delay)
+        for i in range(self.rounds):
+            start = time.time()
+            try:
+                inventory = self.inventory
+                if self.dedup and self.proxy.offers(DEDUP):
+                    inventory = self.send_bodies()
+
+                multicall = xmlrpclib.MultiCall(self.proxy)
+                multicall.authenticate(config.AUTH_TOKEN)
+                multicall.machine(inventory)
+                result = multicall()
+                result[0], result[1]
+            except (socket.error, xmlrpclib.Error, IOError):
+                self.errors += 1
+                self.transport.close()
+                continue
+            self.latencies.append(time.time() - start)
+
+        self.transport.close()
+
+
+def run_clients(uri, inventory, first, count, rounds, ramp, gzip, encoding,
+                dedup):
+    """
+    Run `count` virtual clients (numbered from `first`) to completion and
+    return (latencies, errors, bytes sent, bytes received, start, end).
+    """
+    clients = []
+    for index in range(first, first + count):
+        clients.append(VirtualClient(uri, client_inventory(inventory, index),
+                                     rounds, random.uniform(0, ramp), gzip,
+                                     encoding, dedup))
+
+    start = time.time()
+    for client in clients:
+        client.start()
+    for client in clients:
+        client.join()
+    end = time.time()
+
+    latencies = []
+    errors = sent = received = 0
+    for client in clients:
+        latencies.extend(client.latencies)
+        errors += client.errors
+        sent += client.transport.bytes_sent
+        received += client.transport.bytes_received
+
+    return latencies, errors, sent, received, start, end
+
+
+def run_clients_in_child(*args):
+    """Run `run_clients` in a forked child; return a pipe to its results."""
+    r, w = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(r)
+        try:
+            results = marshal.dumps(run_clients(*args))
+            while results:
+                results = results[os.write(w, results):]
+        finally:
+            os._exit(0)
+
+    os.close(w)
+    return pid, r
+
+
+def read_results(pid, r):
+    data = []
+    while True:
+        chunk = os.read(r, 65536)
+        if not chunk:
+            break
+        data.append(chunk)
+    os.close(r)
+    os.waitpid(pid, 0)
+
+    if not data:
+        return None
+    return marshal.loads(''.join(data))
+
+
+def start_server(gzip):
+    """
+    Start a `MockInventoryServer` on a free port in a child process and
+    return its pid and URI.
+    """
+    server = MockInventoryServer(('localhost', 0), gzip=gzip, keep=False)
+    port = server.server_address[1]
+
+    pid = os.fork()
+    if pid == 0:
+        try:
+            server.serve_forever()
+        finally:
+            os._exit(0)
+
+    server.server_close()
+    return pid, 'http://localhost:%d' % port
+
+
+## Report.
+
+def format_bytes(n):
+    for unit in ('B', 'KiB', 'MiB', 'GiB'):
+        if n < 1024 or unit == 'GiB':
+            return '%.1f %s' % (n, unit)
+        n /= 1024.0
+
+
+def report(options, payload_size, latencies, errors, sent, received, elapsed,
+           stats=None):
+    latencies.sort()
+    uploads = len(latencies)
+
+    print 'clients    %d in %d processes, %d rounds, %.1f s ramp, %s%s' % (
+        options.clients, options.processes, options.rounds, options.ramp,
+        options.encoding, options.dedup and ', dedup' or '')
+    print 'payload    %s per inventory (marshalled)' % \
+        format_bytes(payload_size)
+    print 'uploads    %d ok, %d failed in %.2f s (%.1f uploads/s)' % (
+        uploads, errors, elapsed, elapsed and uploads / elapsed or 0)
+    print 'latency    p50 %.1f  p90 %.1f  p99 %.1f  max %.1f ms' % tuple(
+        [percentile(latencies, p) * 1000 for p in (50, 90, 99, 100)])
+    print 'wire       %s sent, %s received (%s/upload)' % (
+        format_bytes(sent), format_bytes(received),
+        format_bytes(uploads and float(sent) / uploads or 0))
+
+    if stats:
+        print 'server     %s in, %s out uncompressed; request p50 %s, ' \
+              'max %s' % (format_bytes(stats['raw_in']),
+                          format_bytes(stats['raw_out']),
+                          format_bytes(stats['request_size_p50']),
+                          format_bytes(stats['request_size_p100']))
+        if stats.get('bodies_received'):
+            print 'bodies     %d received, %d stored (%s)' % (
+                stats['bodies_received'], stats['bodies_stored'],
+                format_bytes(stats['body_bytes']))
+        for name in ('unmarshal', 'marshal'):
+            print '%-10s p50 %.2f  p90 %.2f  p99 %.2f  max %.2f ms, ' \
+                  '%.2f s total (CPU)' % tuple(
+                [name] + [stats['%s_p%d' % (name, p)] * 1000
+                          for p in (50, 90, 99, 100)] +
+                [stats['%s_total' % name]])
+
+
+if __name__ == '__main__':
+    parser = OptionParser()
+    parser.add_option('--clients', dest='clients', type='int', default=1000,
+                      help='virtual clients')
+    parser.add_option('--processes', dest='processes', type='int', default=4,
+                      help='processes the clients are spread over')
+    parser.add_option('--rounds', dest='rounds', type='int', default=1,
+                      help='uploads per client')
+    parser.add_option('--ramp', dest='ramp', type='float', default=0.0,
+                      help='seconds over which clients start (0: at once)')
+    parser.add_option('--scale', dest='scale', type='int', default=1000,
+                      help='lines per section of the synthetic inventory')
+    parser.add_option('--inventory', dest='inventory', default=None,
+                      metavar='FILE', help='replay an inventory captured by '
+                      '`mockserver.py --capture`')
+    parser.add_option('--host', dest='host', default=None,
+                      help='server URI (default: a local mock server)')
+    parser.add_option('--no-gzip', action='store_false', dest='gzip',
+                      default=True, help='send uncompressed requests')
+    parser.add_option('--encoding', dest='encoding', default='auto',
+                      help='request encoding: auto (compact if offered) or '
+                      'xmlrpc')
+    parser.add_option('--no-dedup', action='store_false', dest='dedup',
+                      default=True, help='always send configuration bodies')
+    options, args = parser.parse_args()
+
+    if options.inventory:
+        inventory = load_inventory(options.inventory)
+    else:
+        inventory = synthetic_inventory(options.scale)
+    payload_size = len(xmlrpclib.dumps((inventory,), 'machine'))
+
+    # Thousands of threads: keep their stacks small.
+    threading.stack_size(256 * 1024)
+
+    server_pid = None
+    if options.host:
+        uri = options.host
+    else:
+        server_pid, uri = start_server(options.gzip)
+        time.sleep(0.2)
+
+    try:
+        processes = max(1, min(options.processes, options.clients))
+        children = []
+        first = 0
+        for i in range(processes):
+            count = options.clients / processes + \
+                    (i < options.clients % processes and 1 or 0)
+            pid, r = run_clients_in_child(uri, inventory, first, count,
+                                          options.rounds, options.ramp,
+                                          options.gzip, options.encoding,
+                                          options.dedup)
+            children.append((pid, r, count))
+            first += count
+
+        latencies = []
+        errors = sent = received = 0
+        start = end = None
+        for pid, r, count in children:
+            results = read_results(pid, r)
+            if results is None:
+                errors += count * options.rounds
+                continue
+            latencies.extend(results[0])
+            errors += results[1]
+            sent += results[2]
+            received += results[3]
+            start = min(start or results[4], results[4])
+            end = max(end, results[5])
+
+        stats = None
+        try:
+            stats = xmlrpclib.ServerProxy(uri).stats()
+        except (socket.error, xmlrpclib.Error):
+            # Not a mock server.
+            pass
+
+        report(options, payload_size, latencies, errors, sent, received,
+               (end or 0) - (start or 0), stats)
+    finally:
+        if server_pid:
+            os.kill(server_pid, signal.SIGTERM)
+            os.waitpid(server_pid, 0)
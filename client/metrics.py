@@ -0,0 +1,141 @@
+import math
+import resource
+import subprocess
+import threading
+import time
+
+from common import *
+
+
+# `RUSAGE_THREAD` (Linux) is missing from Python 2's `resource` module.
+RUSAGE_THREAD = getattr(resource, 'RUSAGE_THREAD', 1)
+
+_local = threading.local()
+
+
+def cpu_time():
+    """Return the CPU time (user + system) of the calling thread."""
+    try:
+        usage = resource.getrusage(RUSAGE_THREAD)
+    except (ValueError, resource.error):
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def _bytes_read():
+    """
+    Return the bytes read so far by the calling thread, and True; or, where
+    `/proc/thread-self` is missing (before Linux 3.17), by the whole
+    process, and False.
+    """
+    for fn, per_thread in (('/proc/thread-self/io', True),
+                           ('/proc/self/io', False)):
+        try:
+            io_file = open(fn, 'r')
+            try:
+                for line in io_file:
+                    if line.startswith('rchar:'):
+                        return int(line.split()[1]), per_thread
+            finally:
+                io_file.close()
+        except IOError:
+            continue
+    return 0, False
+
+
+def _max_rss():
+    """Return the peak resident set size (in KiB) of the process."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def percentile(values, p):
+    """Return the `p`th percentile (nearest rank) of sorted `values`, or 0."""
+    if not values:
+        return 0
+    index = int(math.ceil(p / 100.0 * len(values))) - 1
+    return values[max(0, min(index, len(values) - 1))]
+
+
+def record_subprocess():
+    """Count a subprocess against the collector measured in this thread."""
+    record = getattr(_local, 'record', None)
+    if record is not None:
+        record['subprocesses'] += 1
+
+
+class CountedPopen(subprocess.Popen):
+    """`subprocess.Popen` that counts itself in the current metrics record."""
+    def __init__(self, *args, **kwargs):
+        record_subprocess()
+        subprocess.Popen.__init__(self, *args, **kwargs)
+
+
+class Metrics:
+    """
+    Record wall time, CPU time, subprocess count and bytes read for each
+    collector and for the upload. CPU time and bytes read are per thread,
+    so collectors can be measured while they run concurrently; on kernels
+    without per-thread I/O counters bytes read are process-wide, and the
+    record's `bytes_read_per_thread` is false. Peak RSS is only known for
+    the whole process (`max_rss`).
+    """
+    def __init__(self):
+        self.records = {}
+        self.lock = threading.Lock()
+
+    def measure(self, name, func, *args, **kwargs):
+        """Call `func`, recording its metrics under `name`."""
+        record = {'wall': 0.0, 'cpu': 0.0, 'subprocesses': 0,
+                  'bytes_read': 0, 'bytes_read_per_thread': True}
+        _local.record = record
+
+        wall, cpu = time.time(), cpu_time()
+        bytes_read, per_thread = _bytes_read()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            record['wall'] = time.time() - wall
+            record['cpu'] = cpu_time() - cpu
+            record['bytes_read'] = _bytes_read()[0] - bytes_read
+            record['bytes_read_per_thread'] = per_thread
+            _local.record = None
+
+            self.lock.acquire()
+            try:
+                self.records[name] = record
+            finally:
+                self.lock.release()
+
+    def max_rss(self):
+        """Return the peak resident set size (KiB) of the whole process."""
+        return _max_rss()
+
+    def wrap(self, name, func):
+        """Return `func` wrapped to record its metrics under `name`."""
+        def measured(*args, **kwargs):
+            return self.measure(name, func, *args, **kwargs)
+        return measured
+
+    def report(self):
+        """Return the metrics as a printable table."""
+        lines = ['%-12s %9s %9s %6s %13s' % (
+            'collector', 'wall (s)', 'cpu (s)', 'procs', 'bytes read')]
+
+        process_wide = False
+        names = self.records.keys()
+        names.sort()
+        for name in names:
+            record = self.records[name]
+            mark = ' '
+            if not record['bytes_read_per_thread']:
+                mark = '*'
+                process_wide = True
+            lines.append('%-12s %9.3f %9.3f %6d %12d%s' % (
+                name, record['wall'], record['cpu'], record['subprocesses'],
+                record['bytes_read'], mark))
+
+        if process_wide:
+            lines.append('* bytes read by the whole process meanwhile (no '
+                         'per-thread I/O counters before Linux 3.17)')
+        lines.append('peak RSS of the process: %d KiB' % self.max_rss())
+        return '\n'.join(lines)
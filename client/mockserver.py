@@ -0,0 +1,473 @@
+#!/usr/bin/env python
+"""
+Local stand-in for the LittleSIS XML-RPC server, for testing the client.
+
+    python mockserver.py [--port=8668] [--no-gzip] [--no-compact]
+                         [--no-chunked] [--no-dedup] [--capture=DIR]
+
+Then set `host=http://localhost` in `settings.conf` and run `client.py`.
+With `--capture`, every inventory received is written to DIR as an
+XML-RPC `machine` request (with its bodies restored), which `loadsim.py
+--inventory` can replay.
+"""
+from optparse import OptionParser
+import os
+import SimpleXMLRPCServer
+import SocketServer
+import sys
+import threading
+import time
+import xmlrpclib
+import zlib
+
+from common import *
+from compact import CHUNKED, COMPACT, CONTENT_TYPE, decode_request, \
+                    encode_response, json
+from dedup import DEDUP, digest, resolve_bodies, sha256
+from metrics import cpu_time, percentile
+from transport import gzip_decode, gzip_encode
+
+
+class MockRequestHandler(SimpleXMLRPCServer.SimpleXMLRPCRequestHandler):
+    """
+    Request handler that keeps HTTP/1.1 connections alive and understands
+    gzip-compressed requests and responses.
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        length = int(self.headers.get('content-length') or 0)
+        data = self.rfile.read(length)
+        wire_in = len(data)
+
+        content_type = (self.headers.get('content-type') or '').split(';')[0]
+        compact = content_type.strip().lower() == CONTENT_TYPE
+        if compact and not self.server.compact:
+            self.send_error_response(415)
+            return
+
+        content_encoding = (self.headers.get('content-encoding') or '').lower()
+        if content_encoding in ('gzip', 'deflate'):
+            if not self.server.gzip:
+                self.send_error_response(415)
+                return
+            if content_encoding == 'gzip':
+                data = gzip_decode(data)
+            else:
+                data = zlib.decompress(data)
+
+        response, unmarshal, marshal = self.server.timed_dispatch(data, compact)
+        raw_out = len(response)
+
+        headers = {'Content-Type': compact and CONTENT_TYPE or 'text/xml'}
+        accept_encoding = self.headers.get('accept-encoding') or ''
+        if self.server.gzip and \
+           len(response) >= self.server.compress_threshold:
+            if 'gzip' in accept_encoding:
+                response = gzip_encode(response)
+                headers['Content-Encoding'] = 'gzip'
+            elif 'deflate' in accept_encoding:
+                response = zlib.compress(response, 6)
+                headers['Content-Encoding'] = 'deflate'
+        headers['Content-Length'] = str(len(response))
+
+        self.send_response(200)
+        for key, value in headers.iteritems():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(response)
+
+        self.server.record_request(wire_in, len(response), len(data), raw_out,
+                                   unmarshal, marshal)
+
+    def send_error_response(self, code):
+        self.send_response(code)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            SimpleXMLRPCServer.SimpleXMLRPCRequestHandler.log_message(
+                self, format, *args)
+
+
+class MockInventoryServer(SocketServer.ThreadingMixIn,
+                          SimpleXMLRPCServer.SimpleXMLRPCServer):
+    """
+    Threaded XML-RPC server implementing `authenticate` and `machine`
+    (also in the compact encoding, unless `compact` is false), the chunked
+    upload sessions (unless `chunked` is false) and the configuration body
+    store (unless `dedup` is false). It keeps the
+    received inventories (unless `keep` is false), request/byte counters,
+    and the size and unmarshalling/marshalling time of every request,
+    reported by `stats` (also callable over XML-RPC).
+
+    Sessions idle for `session_timeout` seconds are dropped, and chunks
+    larger than `max_chunk` bytes are refused.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 1024
+
+    def __init__(self, addr=('localhost', 8668), auth_token=None,
+                 gzip=True, compress_threshold=None, verbose=False,
+                 keep=True, capture_dir=None, compact=True, chunked=True,
+                 max_chunk=1048576, session_timeout=3600, dedup=True):
+        if auth_token is None:
+            auth_token = config.AUTH_TOKEN
+        if compress_threshold is None:
+            compress_threshold = config.SERVER_COMPRESS_THRESHOLD
+        SimpleXMLRPCServer.SimpleXMLRPCServer.__init__(
+            self, addr, requestHandler=MockRequestHandler, logRequests=False)
+        self.auth_token = auth_token
+        self.gzip = gzip
+        self.compress_threshold = compress_threshold
+        self.verbose = verbose
+        self.keep = keep
+        self.capture_dir = capture_dir
+        self.compact = compact and json is not None
+        self.chunked = chunked and json is not None
+        self.max_chunk = max_chunk
+        self.session_timeout = session_timeout
+        self.dedup = dedup and sha256 is not None
+
+        self.lock = threading.Lock()
+        self.machines = []
+        self.metrics = []
+        # {session id: [last used, {name: [chunks]}, {name: section}]}.
+        self.sessions = {}
+        # Configuration bodies: {digest: body}.
+        self.bodies = {}
+        self.reset()
+
+        self.register_function(self.authenticate, 'authenticate')
+        self.register_function(self.machine, 'machine')
+        self.register_function(self.encodings, 'encodings')
+        self.register_function(self.session_begin, 'session_begin')
+        self.register_function(self.session_chunk, 'session_chunk')
+        self.register_function(self.session_commit, 'session_commit')
+        self.register_function(self.session_abort, 'session_abort')
+        self.register_function(self.bodies_missing, 'bodies_missing')
+        self.register_function(self.bodies_put, 'bodies_put')
+        self.register_function(self.stats, 'stats')
+        self.register_function(self.reset, 'reset')
+        self.register_multicall_functions()
+
+    def timed_dispatch(self, data, compact=False):
+        """
+        Unmarshal, dispatch and marshal an XML-RPC request (or a `compact`
+        one). Return the response and the CPU seconds spent unmarshalling
+        and marshalling (CPU time, so that concurrent requests do not
+        inflate each other).
+        """
+        unmarshal = 0.0
+        try:
+            start = cpu_time()
+            if compact:
+                params, method = decode_request(data)
+            else:
+                params, method = xmlrpclib.loads(data)
+            unmarshal = cpu_time() - start
+
+            response = (self._dispatch(method, params),)
+        except xmlrpclib.Fault, fault:
+            response = fault
+        except:
+            exc_type, exc_value = sys.exc_info()[:2]
+            response = xmlrpclib.Fault(1, '%s:%s' % (exc_type, exc_value))
+
+        start = cpu_time()
+        if compact:
+            if isinstance(response, tuple):
+                response = response[0]
+            response = encode_response(response)
+        else:
+            response = xmlrpclib.dumps(response, methodresponse=1,
+                                       allow_none=self.allow_none,
+                                       encoding=self.encoding)
+        return response, unmarshal, cpu_time() - start
+
+    def record_request(self, bytes_in, bytes_out, raw_in=0, raw_out=0,
+                       unmarshal=0.0, marshal=0.0):
+        self.lock.acquire()
+        try:
+            self.requests += 1
+            self.bytes_in += bytes_in
+            self.bytes_out += bytes_out
+            self.raw_in += raw_in
+            self.raw_out += raw_out
+            self.request_sizes.append(raw_in)
+            self.unmarshal_times.append(unmarshal)
+            self.marshal_times.append(marshal)
+        finally:
+            self.lock.release()
+
+    def reset(self):
+        """Clear the counters and timings."""
+        self.lock.acquire()
+        try:
+            self.requests = 0
+            self.bytes_in = 0
+            self.bytes_out = 0
+            self.raw_in = 0
+            self.raw_out = 0
+            self.request_sizes = []
+            self.unmarshal_times = []
+            self.marshal_times = []
+            self.inventories = 0
+            self.bodies_received = 0
+        finally:
+            self.lock.release()
+        return True
+
+    def stats(self):
+        """
+        Return the request count, bytes on the wire and uncompressed, the
+        bodies received and stored, and percentiles of request size (bytes)
+        and unmarshalling/marshalling CPU time (seconds). Byte totals are
+        floats (XML-RPC integers are 32-bit).
+        """
+        self.lock.acquire()
+        try:
+            stats = {'requests': self.requests,
+                     'inventories': self.inventories,
+                     'bodies_received': self.bodies_received,
+                     'bodies_stored': len(self.bodies),
+                     'body_bytes': float(sum([len(b) for b in
+                                              self.bodies.itervalues()])),
+                     'bytes_in': float(self.bytes_in),
+                     'bytes_out': float(self.bytes_out),
+                     'raw_in': float(self.raw_in),
+                     'raw_out': float(self.raw_out),
+                     'unmarshal_total': float(sum(self.unmarshal_times)),
+                     'marshal_total': float(sum(self.marshal_times))}
+            for name, values in (('request_size', self.request_sizes),
+                                 ('unmarshal', self.unmarshal_times),
+                                 ('marshal', self.marshal_times)):
+                values = values[:]
+                values.sort()
+                for p in (50, 90, 99, 100):
+                    stats['%s_p%d' % (name, p)] = \
+                        float(percentile(values, p))
+        finally:
+            self.lock.release()
+        return stats
+
+    def authenticate(self, auth_token):
+        return auth_token == self.auth_token
+
+    def encodings(self):
+        """Return the request encodings accepted besides XML-RPC."""
+        encodings = []
+        if self.compact:
+            encodings.append(COMPACT)
+        if self.chunked:
+            encodings.append(CHUNKED)
+        if self.dedup:
+            encodings.append(DEDUP)
+        return encodings
+
+    def check_dedup(self, auth_token):
+        if not self.dedup:
+            raise xmlrpclib.Fault(2, 'Body deduplication is off')
+        if not self.authenticate(auth_token):
+            raise xmlrpclib.Fault(3, 'Authentication failed')
+
+    def bodies_missing(self, auth_token, digests):
+        """Return the `digests` of the bodies not stored yet."""
+        self.check_dedup(auth_token)
+        self.lock.acquire()
+        try:
+            return [d for d in digests if d not in self.bodies]
+        finally:
+            self.lock.release()
+
+    def bodies_put(self, auth_token, bodies):
+        """Store bodies ({digest: body}) after checking their digests."""
+        self.check_dedup(auth_token)
+        for body_digest, body in bodies.iteritems():
+            if digest(body) != body_digest:
+                raise xmlrpclib.Fault(6, "Body does not match digest '%s'"
+                                      % body_digest)
+
+        self.lock.acquire()
+        try:
+            self.bodies_received += len(bodies)
+            self.bodies.update(bodies)
+        finally:
+            self.lock.release()
+        return True
+
+    def resolve(self, sections):
+        """
+        Return a copy of an inventory with its bodies restored; raise a
+        fault for bodies not stored.
+        """
+        self.lock.acquire()
+        try:
+            resolved = {}
+            for name, section in sections.iteritems():
+                try:
+                    resolved[name] = resolve_bodies(section, self.bodies)
+                except KeyError, error:
+                    raise xmlrpclib.Fault(6, "Unknown body '%s' in section "
+                                          "'%s'" % (error.args[0], name))
+        finally:
+            self.lock.release()
+        return resolved
+
+    def get_session(self, session):
+        """Return a session (with the lock held) and mark it used."""
+        if session not in self.sessions:
+            raise xmlrpclib.Fault(2, "Unknown session '%s'" % session)
+        self.sessions[session][0] = time.time()
+        return self.sessions[session]
+
+    def session_begin(self, auth_token):
+        """
+        Start a chunked upload and return its session id, or an empty
+        string if authentication fails.
+        """
+        if not self.chunked:
+            raise xmlrpclib.Fault(2, 'Chunked uploads are off')
+        if not self.authenticate(auth_token):
+            return ''
+
+        self.lock.acquire()
+        try:
+            now = time.time()
+            for session, (used, chunks, sections) in self.sessions.items():
+                if now - used > self.session_timeout:
+                    del self.sessions[session]
+
+            session = os.urandom(16).encode('hex')
+            self.sessions[session] = [now, {}, {}]
+        finally:
+            self.lock.release()
+        return session
+
+    def session_chunk(self, session, name, index, data, final):
+        """
+        Add chunk `index` of section `name`; decode the section if `final`.
+        """
+        if len(data) > self.max_chunk:
+            raise xmlrpclib.Fault(4, 'Chunk larger than %d bytes'
+                                  % self.max_chunk)
+
+        self.lock.acquire()
+        try:
+            used, chunks, sections = self.get_session(session)
+            if name in sections:
+                # Already complete: a retried final chunk.
+                return True
+            received = chunks.setdefault(name, [])
+            if index < len(received):
+                # A retried chunk.
+                return True
+            if index > len(received):
+                raise xmlrpclib.Fault(5, "Missing chunk %d of section '%s'"
+                                      % (len(received), name))
+            received.append(data)
+            if not final:
+                return True
+            del chunks[name]
+        finally:
+            self.lock.release()
+
+        section = json.loads(''.join(received))
+        self.lock.acquire()
+        try:
+            self.get_session(session)[2][name] = section
+        finally:
+            self.lock.release()
+        return True
+
+    def session_commit(self, session, metrics=None):
+        """Keep the sections of a session as one inventory."""
+        self.lock.acquire()
+        try:
+            used, chunks, sections = self.get_session(session)
+            if chunks:
+                raise xmlrpclib.Fault(5, "Incomplete sections '%s'"
+                                      % "', '".join(chunks.keys()))
+            del self.sessions[session]
+        finally:
+            self.lock.release()
+        return self.machine(sections, metrics or None)
+
+    def session_abort(self, session):
+        """Drop a session and the chunks received."""
+        self.lock.acquire()
+        try:
+            self.sessions.pop(session, None)
+        finally:
+            self.lock.release()
+        return True
+
+    def capture(self, sections):
+        """Write an inventory to the capture directory."""
+        fn = os.path.join(self.capture_dir, 'machine-%06d.xml'
+                          % self.inventories)
+        capture_file = open(fn, 'w')
+        try:
+            capture_file.write(xmlrpclib.dumps((sections,), 'machine',
+                                               allow_none=self.allow_none))
+        finally:
+            capture_file.close()
+
+    def machine(self, sections, metrics=None):
+        """
+        Keep an inventory ({name: section}) and its collector metrics.
+        Bodies sent by digest are kept that way.
+        """
+        resolved = self.resolve(sections)
+
+        self.lock.acquire()
+        try:
+            if self.capture_dir:
+                self.capture(resolved)
+            self.inventories += 1
+            if self.keep:
+                self.machines.append(sections)
+                if metrics is not None:
+                    self.metrics.append(metrics)
+        finally:
+            self.lock.release()
+        return True
+
+    def start(self):
+        """Serve requests in a background thread."""
+        thread = threading.Thread(target=self.serve_forever)
+        thread.setDaemon(True)
+        thread.start()
+        return thread
+
+
+if __name__ == '__main__':
+    parser = OptionParser()
+    parser.add_option('--port', dest='port', type='int', default=int(config.PORT))
+    parser.add_option('--no-gzip', action='store_false', dest='gzip',
+                      default=True, help='reject compressed requests')
+    parser.add_option('--no-compact', action='store_false', dest='compact',
+                      default=True, help='accept XML-RPC requests only')
+    parser.add_option('--no-chunked', action='store_false', dest='chunked',
+                      default=True, help='refuse chunked uploads')
+    parser.add_option('--no-dedup', action='store_false', dest='dedup',
+                      default=True, help='refuse bodies sent by digest')
+    parser.add_option('--capture', dest='capture_dir', default=None,
+                      metavar='DIR', help='write received inventories to DIR')
+    parser.add_option('--verbose', action='store_true', dest='verbose',
+                      default=False)
+    options, args = parser.parse_args()
+
+    server = MockInventoryServer(('localhost', options.port),
+                                 gzip=options.gzip, verbose=options.verbose,
+                                 keep=False, capture_dir=options.capture_dir,
+                                 compact=options.compact,
+                                 chunked=options.chunked,
+                                 dedup=options.dedup)
+    print 'Listening on http://localhost:%d' % options.port
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,78 @@
+import Queue
+import sys
+import threading
+
+from common import *
+
+
+class CollectorRunner:
+    """
+    Run independent collectors on a bounded pool of worker threads and
+    return their results in the order the collectors were added (`run`),
+    or as they finish (`iter_run`).
+    """
+    def __init__(self, workers=None):
+        if workers is None:
+            workers = config.WORKER_THREADS
+        self.workers = max(1, workers)
+        self.jobs = []
+
+    def add(self, func, *args, **kwargs):
+        """Queue a collector callable (and its arguments) to be run."""
+        self.jobs.append((func, args, kwargs))
+
+    def _worker(self, queue, done):
+        while True:
+            try:
+                index, (func, args, kwargs) = queue.get_nowait()
+            except Queue.Empty:
+                return
+
+            try:
+                done.put((index, func(*args, **kwargs), None))
+            except:
+                done.put((index, None, sys.exc_info()))
+
+    def iter_run(self):
+        """
+        Run all queued collectors and generate (index, result) pairs as
+        they finish. The first collector exception (in queued order) is
+        re-raised once all have finished.
+        """
+        # A single worker runs the collectors in the calling thread.
+        if self.workers == 1:
+            for index, (func, args, kwargs) in enumerate(self.jobs):
+                yield index, func(*args, **kwargs)
+            return
+
+        queue = Queue.Queue()
+        for index, job in enumerate(self.jobs):
+            queue.put((index, job))
+
+        done = Queue.Queue()
+        for i in range(min(self.workers, len(self.jobs))):
+            t = threading.Thread(target=self._worker, args=(queue, done))
+            t.setDaemon(True)
+            t.start()
+
+        errors = [None] * len(self.jobs)
+        for i in range(len(self.jobs)):
+            index, result, error = done.get()
+            if error:
+                errors[index] = error
+            else:
+                yield index, result
+
+        for error in errors:
+            if error:
+                raise error[0], error[1], error[2]
+
+    def run(self):
+        """
+        Run all queued collectors and return a list of their results. The
+        first collector exception (in queued order) is re-raised.
+        """
+        results = [None] * len(self.jobs)
+        for index, result in self.iter_run():
+            results[index] = result
+        return results
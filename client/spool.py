@@ -0,0 +1,254 @@
+import cPickle
+import errno
+import os
+import shutil
+import time
+import xmlrpclib
+
+from common import *
+from transport import gzip_decode, gzip_encode
+
+
+def write_atomic(fn, data):
+    """Write `data` to `fn` through a temporary file and a rename."""
+    tmp_fn = '%s.tmp' % fn
+    out_file = open(tmp_fn, 'wb')
+    try:
+        out_file.write(data)
+    finally:
+        out_file.close()
+    os.rename(tmp_fn, fn)
+
+
+def _running(pid):
+    """Return whether process `pid` exists."""
+    try:
+        os.kill(pid, 0)
+    except OSError, error:
+        return error.errno == errno.EPERM
+    return True
+
+
+def _link_or_copy(src, dst):
+    try:
+        os.link(src, dst)
+    except (OSError, AttributeError):
+        shutil.copyfile(src, dst)
+
+
+class SectionStore:
+    """
+    Directory keeping the latest result of each collector on disk, one
+    gzip-compressed pickle per section, with a dictionary interface
+    ({name: result}). Pickles carry any result unchanged (XML-RPC cannot
+    carry strings that are not UTF-8). The agent keeps results here rather
+    than in memory, so a streamed upload holds one section at a time.
+    """
+    suffix = '.pickle.gz'
+
+    def __init__(self, directory):
+        self.directory = path(directory)
+
+    @classmethod
+    def for_process(cls, directory):
+        """
+        Return an empty store in a subdirectory of `directory` named after
+        this process, so clients running at once (e.g., from cron and by
+        hand) keep their results apart. Stores of processes that are gone
+        are removed.
+        """
+        directory = path(directory)
+        try:
+            names = os.listdir(directory)
+        except OSError:
+            names = []
+
+        for name in names:
+            if name.isdigit() and (int(name) == os.getpid() or
+                                   not _running(int(name))):
+                shutil.rmtree(os.path.join(directory, name), True)
+
+        return cls(os.path.join(directory, str(os.getpid())))
+
+    def filename(self, name):
+        return os.path.join(self.directory, '%s%s' % (name, self.suffix))
+
+    def keys(self):
+        try:
+            return [fn[:-len(self.suffix)] for fn in os.listdir(self.directory)
+                    if fn.endswith(self.suffix)]
+        except OSError:
+            return []
+
+    def __contains__(self, name):
+        return os.path.exists(self.filename(name))
+
+    def __setitem__(self, name, result):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        data = cPickle.dumps(result, cPickle.HIGHEST_PROTOCOL)
+        write_atomic(self.filename(name), gzip_encode(data))
+
+    def __getitem__(self, name):
+        # A missing or unreadable section counts as no result.
+        try:
+            section_file = open(self.filename(name), 'rb')
+            try:
+                return cPickle.loads(gzip_decode(section_file.read()))
+            finally:
+                section_file.close()
+        except (IOError, EOFError, ValueError, cPickle.UnpicklingError):
+            raise KeyError(name)
+
+    def get(self, name, default=None):
+        try:
+            return self[name]
+        except KeyError:
+            return default
+
+    def iteritems(self):
+        """Generate the (name, result) pairs that can be read, one by one."""
+        for name in self.keys():
+            result = self.get(name)
+            if result is not None:
+                yield name, result
+
+    def size(self):
+        """Return the bytes used on disk."""
+        total = 0
+        for name in self.keys():
+            try:
+                total += os.path.getsize(self.filename(name))
+            except OSError:
+                pass
+        return total
+
+    def copy(self, directory, names):
+        """Copy (hard-link) the named sections into a new `directory`."""
+        os.makedirs(directory)
+        for name in names:
+            _link_or_copy(self.filename(name),
+                          os.path.join(directory, os.path.basename(
+                              self.filename(name))))
+
+
+class Spool:
+    """
+    Bounded directory of inventories that could not be uploaded, each kept
+    as a gzip-compressed XML-RPC `machine` request, or (when the agent
+    keeps results on disk) as a directory of sections (`SectionStore`).
+    Spooled inventories are full (never deltas), so any of them can be
+    sent on its own.
+
+    Once more than `max_files` inventories or `max_bytes` bytes are
+    spooled, the oldest are dropped (the newest is always kept).
+    """
+    suffix = '.xml.gz'
+    dir_suffix = '.d'
+
+    def __init__(self, directory=None, max_files=None, max_bytes=None):
+        if directory is None:
+            directory = config.SPOOL_DIR
+        if max_files is None:
+            max_files = config.SPOOL_MAX_FILES
+        if max_bytes is None:
+            max_bytes = config.SPOOL_MAX_BYTES
+        self.directory = path(directory)
+        self.max_files = max_files
+        self.max_bytes = max_bytes
+
+    def names(self):
+        """Return the spooled inventory names, oldest first."""
+        try:
+            names = [fn for fn in os.listdir(self.directory)
+                     if fn.endswith(self.suffix) or
+                     fn.endswith(self.dir_suffix)]
+        except OSError:
+            return []
+        # Names are zero-padded timestamps.
+        names.sort()
+        return names
+
+    def new_name(self, suffix):
+        stamp = int(time.time() * 1000)
+        while os.path.exists(os.path.join(self.directory, '%015d%s'
+                                          % (stamp, suffix))):
+            stamp += 1
+        return '%015d%s' % (stamp, suffix)
+
+    def put(self, sections, names=None):
+        """
+        Spool an inventory, either {name: section} or a `SectionStore`
+        (copied as a directory, only its `names` sections if given), and
+        enforce the bounds.
+        """
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+
+            if isinstance(sections, SectionStore):
+                fn = os.path.join(self.directory,
+                                  self.new_name(self.dir_suffix))
+                tmp_fn = '%s.tmp' % fn
+                if names is None:
+                    names = sections.keys()
+                sections.copy(tmp_fn, names)
+                os.rename(tmp_fn, fn)
+            else:
+                body = gzip_encode(xmlrpclib.dumps((sections,), 'machine'))
+                write_atomic(os.path.join(self.directory,
+                                          self.new_name(self.suffix)), body)
+        except (IOError, OSError), error:
+            print "Notice: Cannot spool inventory in '%s': %s" % (
+                self.directory, error)
+            return
+
+        self.trim()
+
+    def get(self, name):
+        """
+        Return the inventory spooled as `name`: {name: section}, or a
+        `SectionStore` for a spooled directory.
+        """
+        fn = os.path.join(self.directory, name)
+        if name.endswith(self.dir_suffix):
+            return SectionStore(fn)
+
+        spool_file = open(fn, 'rb')
+        try:
+            params, method = xmlrpclib.loads(gzip_decode(spool_file.read()))
+        finally:
+            spool_file.close()
+        return params[0]
+
+    def remove(self, name):
+        fn = os.path.join(self.directory, name)
+        if name.endswith(self.dir_suffix):
+            shutil.rmtree(fn, True)
+            return
+        try:
+            os.unlink(fn)
+        except OSError:
+            pass
+
+    def trim(self):
+        """Drop the oldest inventories beyond the bounds."""
+        names = self.names()
+        sizes = {}
+        for name in names:
+            fn = os.path.join(self.directory, name)
+            if name.endswith(self.dir_suffix):
+                sizes[name] = SectionStore(fn).size()
+                continue
+            try:
+                sizes[name] = os.path.getsize(fn)
+            except OSError:
+                sizes[name] = 0
+
+        total = sum(sizes.values())
+        while len(names) > 1 and (len(names) > self.max_files or
+                                  total > self.max_bytes):
+            name = names.pop(0)
+            total -= sizes[name]
+            self.remove(name)
+            print "Notice: Dropped spooled inventory '%s'" % name
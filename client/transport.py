@@ -0,0 +1,204 @@
+import cStringIO
+import errno
+import gzip
+import httplib
+import socket
+import xmlrpclib
+import zlib
+
+from common import *
+
+
+def gzip_encode(data):
+    """Return `data` compressed with gzip."""
+    buf = cStringIO.StringIO()
+    gz = gzip.GzipFile(mode='wb', fileobj=buf, compresslevel=6)
+    gz.write(data)
+    gz.close()
+    return buf.getvalue()
+
+
+def gzip_decode(data):
+    """Return gzip-compressed `data` decompressed."""
+    gz = gzip.GzipFile(mode='rb', fileobj=cStringIO.StringIO(data))
+    try:
+        return gz.read()
+    finally:
+        gz.close()
+
+
+class CompressedTransport(xmlrpclib.Transport):
+    """
+    XML-RPC transport that keeps one persistent HTTP/1.1 connection open
+    between requests, gzip-compresses request bodies (falling back to plain
+    requests if the server rejects them), accepts gzip-compressed responses
+    and applies a socket timeout. `raw_request` sends bodies in other
+    encodings (see `compact.py`) over the same connection.
+    """
+    user_agent = 'littlesis-client'
+
+    def __init__(self, secure=False, timeout=None, compress=None,
+                 compress_threshold=None):
+        if timeout is None:
+            timeout = config.SERVER_TIMEOUT
+        if compress is None:
+            compress = config.SERVER_COMPRESS
+        if compress_threshold is None:
+            compress_threshold = config.SERVER_COMPRESS_THRESHOLD
+        xmlrpclib.Transport.__init__(self)
+        self.secure = secure
+        self.timeout = timeout
+        self.compress = compress
+        self.compress_threshold = compress_threshold
+        self.connection = None
+        self.connection_host = None
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        # Whether the last `send` got the request body out.
+        self.request_sent = False
+
+    def connect(self, host):
+        """Return the open connection to `host` (opening one if needed)."""
+        if self.connection is not None and self.connection_host == host:
+            return self.connection
+        self.close()
+
+        if self.secure:
+            connection_class = httplib.HTTPSConnection
+        else:
+            connection_class = httplib.HTTPConnection
+
+        # The timeout must apply to connecting too, or a server that drops
+        # packets hangs the client in `connect`.
+        try:
+            conn = connection_class(host, timeout=self.timeout)
+        except TypeError:
+            # Python 2.4 and 2.5 have no `timeout` argument: use the default
+            # timeout for the socket created by `connect`.
+            conn = connection_class(host)
+            default_timeout = socket.getdefaulttimeout()
+            socket.setdefaulttimeout(self.timeout)
+            try:
+                conn.connect()
+            finally:
+                socket.setdefaulttimeout(default_timeout)
+        else:
+            conn.connect()
+
+        self.connection = conn
+        self.connection_host = host
+        return conn
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+        self.connection = None
+        self.connection_host = None
+
+    def send(self, host, handler, body, headers):
+        conn = self.connect(host)
+
+        headers = headers.copy()
+        headers['User-Agent'] = self.user_agent
+
+        self.request_sent = False
+        conn.request('POST', handler, body, headers)
+        self.request_sent = True
+        response = conn.getresponse()
+        data = response.read()
+
+        self.bytes_sent += len(body)
+        self.bytes_received += len(data)
+
+        if (response.getheader('connection') or '').lower() == 'close':
+            self.close()
+
+        return response, data
+
+    def stale(self, error):
+        """
+        Return whether `error`, raised by `send` on a kept-alive connection,
+        means the server had closed it before the request reached it: no
+        status line came back, or the connection was reset while sending.
+        Timeouts never count, as the server may still be handling the
+        request.
+        """
+        if isinstance(error, httplib.BadStatusLine):
+            return True
+        if isinstance(error, socket.timeout) or \
+           not isinstance(error, socket.error):
+            return False
+        return not self.request_sent and \
+               error.args[0] in (errno.ECONNRESET, errno.EPIPE)
+
+    def post(self, host, handler, body, headers):
+        """
+        Send `body` and return the response and its body, retrying once on
+        a fresh connection if the kept-alive one went stale (see `stale`).
+        Other errors are not retried here, since the server may have
+        received the request.
+        """
+        reused = self.connection is not None and self.connection_host == host
+        try:
+            return self.send(host, handler, body, headers)
+        except (socket.error, httplib.HTTPException), error:
+            self.close()
+            if not reused or not self.stale(error):
+                raise
+        return self.send(host, handler, body, headers)
+
+    def response_body(self, host, handler, response, data):
+        """Check the response status and return its decompressed body."""
+        if response.status != 200:
+            self.close()
+            raise xmlrpclib.ProtocolError(host + handler, response.status,
+                                          response.reason, response.msg)
+
+        content_encoding = (response.getheader('content-encoding') or '').lower()
+        if content_encoding == 'gzip':
+            data = gzip_decode(data)
+        elif content_encoding == 'deflate':
+            data = zlib.decompress(data)
+        return data
+
+    def raw_request(self, host, handler, body, content_type):
+        """
+        Send an already encoded request body (deflated if compression is
+        on) and return the response body.
+        """
+        headers = {'Content-Type': content_type,
+                   'Accept-Encoding': 'gzip, deflate'}
+        if self.compress and len(body) >= self.compress_threshold:
+            body = zlib.compress(body, 6)
+            headers['Content-Encoding'] = 'deflate'
+
+        response, data = self.post(host, handler, body, headers)
+        return self.response_body(host, handler, response, data)
+
+    def request(self, host, handler, request_body, verbose=0):
+        """Send a request and return the unmarshalled response."""
+        headers = {'Content-Type': 'text/xml', 'Accept-Encoding': 'gzip'}
+
+        compressed = self.compress and \
+                     len(request_body) >= self.compress_threshold
+        if compressed:
+            body = gzip_encode(request_body)
+            headers['Content-Encoding'] = 'gzip'
+        else:
+            body = request_body
+
+        response, data = self.post(host, handler, body, headers)
+
+        # Server does not accept compressed requests; stop compressing.
+        if compressed and response.status in (400, 415):
+            self.compress = False
+            del headers['Content-Encoding']
+            response, data = self.post(host, handler, request_body, headers)
+
+        data = self.response_body(host, handler, response, data)
+
+        self.verbose = verbose
+        p, u = self.getparser()
+        p.feed(data)
+        p.close()
+        return u.close()
@@ -0,0 +1,239 @@
+import os
+import select
+import struct
+import time
+
+from common import *
+
+try:
+    import ctypes
+    import ctypes.util
+except ImportError:
+    # Python 2.4.
+    ctypes = None
+
+
+# inotify event masks (from `sys/inotify.h`).
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+
+IN_WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | \
+                IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF
+
+# struct inotify_event {int wd; uint32_t mask, cookie, len; char name[];}
+INOTIFY_EVENT = 'iIII'
+INOTIFY_EVENT_SIZE = struct.calcsize(INOTIFY_EVENT)
+
+
+class Watcher:
+    """
+    Map watched files and directories to the collectors that read them, and
+    notice changes by comparing `stat` results every `poll_interval`
+    seconds: of each watched file, and of the entries of each watched
+    directory (e.g., a new `conf.d` file). A file replaced by a rename (as
+    editors and package managers do) changes inode, so it is noticed too.
+
+    Subclasses (`InotifyWatcher`) override `update` and `wait`.
+    """
+    def __init__(self, poll_interval=None):
+        if poll_interval is None:
+            poll_interval = config.WATCH_POLL_INTERVAL
+        self.poll_interval = poll_interval
+        self.files = {}
+        self.dirs = {}
+        self.file_snapshots = {}
+        self.dir_snapshots = {}
+
+    def watch(self, name, files=(), dirs=()):
+        """Replace the paths watched for collector `name`."""
+        for registry in (self.files, self.dirs):
+            for names in registry.values():
+                names.discard(name)
+
+        for fn in files:
+            self.files.setdefault(os.path.abspath(fn), set()).add(name)
+        for dn in dirs:
+            self.dirs.setdefault(os.path.abspath(dn), set()).add(name)
+
+        for registry in (self.files, self.dirs):
+            for key, names in registry.items():
+                if not names:
+                    del registry[key]
+
+        self.update()
+
+    def watched_dirs(self):
+        """
+        Return the set of directories to watch for changes to both the
+        watched directories and files (files through their parents).
+        """
+        dirs = set(self.dirs.keys())
+        for fn in self.files:
+            dirs.add(os.path.dirname(fn))
+        return dirs
+
+    def affected(self, dn, basename=None):
+        """
+        Return the names of the collectors affected by a change to
+        `basename` in directory `dn` (or to the directory itself).
+        """
+        names = set(self.dirs.get(dn, ()))
+        if basename is None:
+            for fn, fn_names in self.files.iteritems():
+                if os.path.dirname(fn) == dn:
+                    names |= fn_names
+        else:
+            names |= self.files.get(os.path.join(dn, basename), set())
+        return names
+
+    def stat(self, fn):
+        """Return the (mtime, size, inode) of `fn`, or None if missing."""
+        try:
+            st = os.stat(fn)
+        except OSError:
+            return None
+        return (st.st_mtime, st.st_size, st.st_ino)
+
+    def snapshot(self, dn):
+        """Return a dictionary of (mtime, size, inode) for files in `dn`."""
+        snapshot = {}
+        try:
+            basenames = os.listdir(dn)
+        except OSError:
+            return snapshot
+
+        for basename in basenames:
+            st = self.stat(os.path.join(dn, basename))
+            if st is not None:
+                snapshot[basename] = st
+
+        return snapshot
+
+    def update(self):
+        """Start (or stop) watching paths after `watch`."""
+        for fn in self.file_snapshots.keys():
+            if fn not in self.files:
+                del self.file_snapshots[fn]
+        for fn in self.files:
+            if fn not in self.file_snapshots:
+                self.file_snapshots[fn] = self.stat(fn)
+
+        for dn in self.dir_snapshots.keys():
+            if dn not in self.dirs:
+                del self.dir_snapshots[dn]
+        for dn in self.dirs:
+            if dn not in self.dir_snapshots:
+                self.dir_snapshots[dn] = self.snapshot(dn)
+
+    def changed(self):
+        """Return the names of the collectors affected since the last call."""
+        names = set()
+
+        for fn, old in self.file_snapshots.items():
+            new = self.stat(fn)
+            if new != old:
+                self.file_snapshots[fn] = new
+                names |= self.files[fn]
+
+        for dn, old in self.dir_snapshots.items():
+            new = self.snapshot(dn)
+            if new == old:
+                continue
+            self.dir_snapshots[dn] = new
+
+            for basename in set(old.keys()) | set(new.keys()):
+                if old.get(basename) != new.get(basename):
+                    names |= self.affected(dn, basename)
+
+        return names
+
+    def wait(self, timeout):
+        """
+        Wait up to `timeout` seconds for changes and return the set of
+        names of affected collectors (empty on timeout).
+        """
+        deadline = time.time() + timeout
+
+        while True:
+            names = self.changed()
+            remaining = deadline - time.time()
+            if names or remaining <= 0:
+                return names
+            time.sleep(min(self.poll_interval, remaining))
+
+
+class InotifyWatcher(Watcher):
+    """Watch directories with inotify (through `ctypes`)."""
+    def __init__(self):
+        Watcher.__init__(self)
+
+        if ctypes is None:
+            raise OSError('ctypes is unavailable')
+
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                                use_errno=True)
+        self.fd = self.libc.inotify_init()
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init failed')
+
+        self.wds = {}
+
+    def update(self):
+        dirs = self.watched_dirs()
+
+        for dn, wd in self.wds.items():
+            if dn not in dirs:
+                self.libc.inotify_rm_watch(self.fd, wd)
+                del self.wds[dn]
+
+        for dn in dirs:
+            if dn in self.wds:
+                continue
+            wd = self.libc.inotify_add_watch(self.fd, dn, IN_WATCH_MASK)
+            # Missing directories are skipped.
+            if wd >= 0:
+                self.wds[dn] = wd
+
+    def wait(self, timeout):
+        names = set()
+
+        readable = select.select([self.fd], [], [], max(0, timeout))[0]
+        if not readable:
+            return names
+
+        data = os.read(self.fd, 65536)
+        dirs = dict([(wd, dn) for dn, wd in self.wds.iteritems()])
+
+        offset = 0
+        while offset + INOTIFY_EVENT_SIZE <= len(data):
+            wd, mask, cookie, length = struct.unpack_from(INOTIFY_EVENT, data,
+                                                          offset)
+            offset += INOTIFY_EVENT_SIZE
+            basename = data[offset:offset + length].rstrip('\0') or None
+            offset += length
+
+            if mask & IN_Q_OVERFLOW:
+                # Events were lost; every collector is affected.
+                for registry in (self.files, self.dirs):
+                    for fn_names in registry.values():
+                        names |= fn_names
+            elif wd in dirs:
+                names |= self.affected(dirs[wd], basename)
+
+        return names
+
+
+def get_watcher():
+    """Return an inotify watcher, or a polling one if inotify is unavailable."""
+    try:
+        return InotifyWatcher()
+    except (OSError, AttributeError, TypeError):
+        # TypeError: `ctypes` before Python 2.6 has no `use_errno`.
+        return Watcher()